@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import Domain, KeywordFile, Template, TemplateItem, Conversation, Message, AIModel, Project, ProjectUser, ProjectDomain, Keyword, KeywordPosition, Brand, BrandDomain, Competition, Sitemap, Answer
+from .models import Domain, KeywordFile, Template, TemplateItem, Conversation, Message, AIModel, Project, ProjectUser, ProjectDomain, Keyword, KeywordPosition, PositionSnapshot, Brand, BrandDomain, Competition, Sitemap, Answer, CompletionCache
+from .sitemaps import invalidate_sitemap_cache
 
 class BrandInlineAdmin(admin.TabularInline):
     model = BrandDomain
@@ -89,11 +90,34 @@ class KeywordAdmin(admin.ModelAdmin):
 class KeywordPositionAdmin(admin.ModelAdmin):
     list_display = ('keyword_text', 'domain_text', 'keyword', 'domain', 'position')
 
+@admin.register(PositionSnapshot)
+class PositionSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('keyword', 'domain', 'retrieved_on', 'position', 'search_volume')
+    raw_id_fields = ('keyword', 'domain', 'url', 'serp_features', 'intents')
+
 @admin.register(Sitemap)
 class SitemapAdmin(admin.ModelAdmin):
-    list_display = ('url', 'lastmod', 'category')
+    list_display = ('url', 'lastmod', 'category', 'shard', 'max_updated_at')
+
+    # Static urls are edited here; drop the cached sitemap responses so the change is served right away
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_sitemap_cache()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_sitemap_cache()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        invalidate_sitemap_cache()
 
 @admin.register(Answer)
 class AnswerAdmin(admin.ModelAdmin):
     list_display = ('ai_model', 'keyword_id')
-    fields = ('answer', 'ai_model')
\ No newline at end of file
+    fields = ('answer', 'ai_model')
+
+@admin.register(CompletionCache)
+class CompletionCacheAdmin(admin.ModelAdmin):
+    list_display = ('ai_model', 'prompt', 'hits', 'used_at', 'created_at')
+    search_fields = ['prompt']
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+import datetime, hashlib, re
+
+from ranker.connections import app_redis
+from ranker.models import CompletionCache
+
+HITS_KEY    = "completion_cache:hits"
+MISSES_KEY  = "completion_cache:misses"
+
+def normalize_prompt(prompt):
+    return re.sub(r'\s+', ' ', prompt).strip()
+
+def completion_key(ai_model, temperature, prompt):
+    return hashlib.sha256(f"{ai_model}|{temperature}|{normalize_prompt(prompt)}".encode()).hexdigest()
+
+def expires_before():
+    return timezone.now() - datetime.timedelta(days=settings.OPENAI_CACHE_TTL_DAYS)
+
+def fresh_completions():
+    return CompletionCache.objects.filter(created_at__gte=expires_before())
+
+def get_cached_completions(ai_model, temperature, prompts):
+    # Look up many prompts with one query. Returns {prompt: response} for the ones we already have.
+    keys = {completion_key(ai_model, temperature, prompt): prompt for prompt in prompts}
+    entries = fresh_completions().filter(key__in=keys).values_list('id', 'key', 'response')
+    found = {}
+    for entry_id, key, response in entries:
+        found[keys[key]] = response
+    if found:
+        CompletionCache.objects.filter(id__in=[entry[0] for entry in entries]).update(hits=F('hits') + 1, used_at=timezone.now())
+    app_redis.incrby(HITS_KEY, len(found))
+    app_redis.incrby(MISSES_KEY, len(keys) - len(found))
+    return found
+
+def get_cached_completion(ai_model, temperature, prompt):
+    return get_cached_completions(ai_model, temperature, [prompt]).get(prompt)
+
+def store_completions(ai_model, temperature, responses):
+    # responses is {prompt: response}. Entries that already exist (e.g. stored by a concurrent worker) are left alone.
+    CompletionCache.objects.bulk_create([
+        CompletionCache(key=completion_key(ai_model, temperature, prompt), ai_model=ai_model, temperature=temperature, prompt=prompt, response=response)
+        for prompt, response in responses.items()
+    ], ignore_conflicts=True, batch_size=1000)
+
+def store_completion(ai_model, temperature, prompt, response):
+    store_completions(ai_model, temperature, {prompt: response})
+
+def cache_stats():
+    hits    = int(app_redis.get(HITS_KEY) or 0)
+    misses  = int(app_redis.get(MISSES_KEY) or 0)
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0}
+
+def prune_completions():
+    # Drop expired entries, then the least recently used ones beyond the size limit
+    expired, _ = CompletionCache.objects.filter(created_at__lt=expires_before()).delete()
+    cutoff = CompletionCache.objects.order_by('-used_at').values_list('used_at', flat=True)[settings.OPENAI_CACHE_MAX_ENTRIES:settings.OPENAI_CACHE_MAX_ENTRIES+1]
+    evicted = 0
+    if cutoff:
+        evicted, _ = CompletionCache.objects.filter(used_at__lte=cutoff[0]).delete()
+    return expired, evicted
@@ -0,0 +1,125 @@
+from django.conf import settings
+from contextlib import contextmanager, asynccontextmanager
+
+import asyncio, logging, math, time, uuid
+import openai
+
+from ranker.connections import app_redis
+
+logger = logging.getLogger(__name__)
+
+# Claim one in-flight slot if fewer than floor(limit) are held. Slots are scored by their expiry time,
+# so a worker that dies mid-request can't leak capacity forever.
+ACQUIRE_SCRIPT = app_redis.register_script("""
+local time  = redis.call('TIME')
+local now   = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local limit = tonumber(redis.call('GET', KEYS[2]) or ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < math.floor(limit) then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+    return 1
+end
+return 0
+""")
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD controller for the number of requests allowed in flight across every worker.
+    Each request records its latency and whether it was throttled. At most once per adjust interval,
+    one worker looks at the recent samples: if the congestion rate or p95 latency is over target the
+    limit is cut multiplicatively, otherwise it grows by a fixed step. Throughput then settles just
+    under the provider ceiling instead of swinging between saturation and backoff.
+    """
+    def __init__(self, name, congestion_errors):
+        self.name = name
+        self.congestion_errors = congestion_errors
+        self.limit_key      = f"concurrency:{name}:limit"
+        self.inflight_key   = f"concurrency:{name}:inflight"
+        self.samples_key    = f"concurrency:{name}:samples"
+        self.adjust_key     = f"concurrency:{name}:adjusting"
+
+    def limit(self):
+        value = app_redis.get(self.limit_key)
+        return float(value) if value else float(settings.OPENAI_CONCURRENCY_INITIAL)
+
+    def in_flight(self):
+        return app_redis.zcount(self.inflight_key, time.time(), '+inf')
+
+    def try_acquire(self):
+        slot = uuid.uuid4().hex
+        if ACQUIRE_SCRIPT(keys=[self.inflight_key, self.limit_key], args=[settings.OPENAI_CONCURRENCY_INITIAL, slot, settings.OPENAI_CONCURRENCY_SLOT_TIMEOUT]):
+            return slot
+        return None
+
+    def release(self, slot):
+        app_redis.zrem(self.inflight_key, slot)
+
+    def record(self, latency, congested):
+        pipe = app_redis.pipeline()
+        pipe.lpush(self.samples_key, f"{latency:.3f}:{int(congested)}")
+        pipe.ltrim(self.samples_key, 0, settings.OPENAI_CONCURRENCY_WINDOW - 1)
+        pipe.execute()
+        # Only one worker per interval gets to adjust the limit
+        if app_redis.set(self.adjust_key, 1, nx=True, ex=settings.OPENAI_CONCURRENCY_ADJUST_SECONDS):
+            self.adjust()
+
+    def adjust(self):
+        samples = [sample.decode().split(':') for sample in app_redis.lrange(self.samples_key, 0, -1)]
+        if len(samples) < settings.OPENAI_CONCURRENCY_MIN_SAMPLES:
+            return
+        latencies = sorted(float(latency) for latency, congested in samples)
+        p95 = latencies[min(math.ceil(len(latencies) * 0.95), len(latencies)) - 1]
+        congestion_rate = sum(int(congested) for latency, congested in samples) / len(samples)
+
+        limit = self.limit()
+        if congestion_rate > settings.OPENAI_CONCURRENCY_MAX_ERROR_RATE or p95 > settings.OPENAI_CONCURRENCY_TARGET_P95:
+            new_limit = max(settings.OPENAI_CONCURRENCY_MIN, limit * settings.OPENAI_CONCURRENCY_DECREASE_FACTOR)
+        else:
+            new_limit = min(settings.OPENAI_CONCURRENCY_MAX, limit + settings.OPENAI_CONCURRENCY_INCREASE_STEP)
+
+        pipe = app_redis.pipeline()
+        pipe.set(self.limit_key, new_limit)
+        pipe.delete(self.samples_key) # Judge the new limit on fresh samples only
+        pipe.execute()
+        if int(new_limit) != int(limit):
+            logger.info(f"{self.name} concurrency limit {int(limit)} -> {int(new_limit)} (congestion {congestion_rate:.1%}, p95 {p95:.1f}s)")
+
+    def finish(self, slot, latency, congested):
+        self.release(slot)
+        self.record(latency, congested)
+
+    @contextmanager
+    def slot(self):
+        slot = self.try_acquire()
+        while slot is None:
+            time.sleep(settings.OPENAI_CONCURRENCY_POLL_SECONDS)
+            slot = self.try_acquire()
+        start = time.monotonic()
+        congested = False
+        try:
+            yield
+        except self.congestion_errors:
+            congested = True
+            raise
+        finally:
+            self.finish(slot, time.monotonic() - start, congested)
+
+    @asynccontextmanager
+    async def aslot(self):
+        # Same as slot, with the synchronous Redis calls run in a thread so polling never blocks the event loop
+        slot = await asyncio.to_thread(self.try_acquire)
+        while slot is None:
+            await asyncio.sleep(settings.OPENAI_CONCURRENCY_POLL_SECONDS)
+            slot = await asyncio.to_thread(self.try_acquire)
+        start = time.monotonic()
+        congested = False
+        try:
+            yield
+        except self.congestion_errors:
+            congested = True
+            raise
+        finally:
+            await asyncio.to_thread(self.finish, slot, time.monotonic() - start, congested)
+
+openai_concurrency = AdaptiveConcurrency('openai', (openai.error.RateLimitError, openai.error.Timeout, openai.error.ServiceUnavailableError))
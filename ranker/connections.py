@@ -0,0 +1,6 @@
+import os
+import redis
+
+# Shared application state (rate limits, counters, buffers) lives in its own Redis database so that
+# flushing the Celery broker (db 0) or result backend (db 1) never wipes it.
+app_redis = redis.Redis(host=os.getenv("REDIS_HOST"), port=6379, db=2, password=os.getenv("REDIS_PASS"))
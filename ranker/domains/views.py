@@ -1,10 +1,9 @@
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 from django.utils import timezone, html
 from django.core.paginator import (Paginator, EmptyPage, PageNotAnInteger,)
-from django.core.management import call_command
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView, FormView
@@ -18,9 +17,9 @@ from _keenthemes.__init__ import KTLayout
 from _keenthemes.libs.theme import KTTheme
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 
-from ranker.models import Domain, KeywordFile, Conversation, Template, TemplateItem, Message, Project, ProjectUser, ProjectDomain, AIModel, Keyword, Brand, BrandKeyword, Statistic, add_value
+from ranker.models import Domain, KeywordFile, Conversation, Template, TemplateItem, Message, Project, ProjectUser, ProjectDomain, AIModel, Brand, BrandKeyword, Statistic, get_value, claim_keywords, queue_keyword_file
 from ranker.forms import KeywordFileForm, TemplateItemForm, MessageForm, TemplateForm
-from ranker.tasks import call_openai, save_keyword_response, save_business_json, index_brands
+from ranker.tasks import call_openai, save_business_json, index_brands as index_brands_task, queue_keyword_batches, import_keywords
 
 import csv
 import os
@@ -101,12 +100,30 @@ def keywordfile_make_primary(request, domain_id, keywordfile_id):
     for f in files:
         f.primary = False
         f.save()
-    keywordfile.primary = True 
-    keywordfile.save()
-    call_command('importkeywords', kwfile=keywordfile.id)
-    djmessages.success(request, 'Keywords loaded')
+    KeywordFile.objects.filter(pk=keywordfile.id).update(primary=True)
+    if keywordfile.processed_at is None:
+        # Imported by a worker; the domain page polls keywordfile_progress until it finishes. Only the request that
+        # queues the file sends the task, so repeated clicks don't import it twice.
+        if queue_keyword_file(keywordfile.id):
+            import_keywords.delay(keywordfile.id)
+            djmessages.success(request, 'Keyword import queued')
+        else:
+            djmessages.info(request, 'Keyword import already queued or running')
+    else:
+        djmessages.success(request, 'Keywords already loaded')
     return redirect('domain_detail', domain_id=domain_id)
 
+@login_required
+def keywordfile_progress(request, keywordfile_id):
+    keywordfile = get_object_or_404(KeywordFile, pk=keywordfile_id)
+    return JsonResponse({
+        'id': keywordfile.id,
+        'import_status': keywordfile.import_status,
+        'rows_processed': keywordfile.rows_processed,
+        'processed_at': keywordfile.processed_at,
+        'import_error': keywordfile.import_error,
+    })
+
 @login_required
 def get_keyword_responses(request, batch_multiplier=1):
     if os.getenv("ENVIRONMENT") == "production":
@@ -117,31 +134,18 @@ def get_keyword_responses(request, batch_multiplier=1):
         max_queue = 300
 
     kw_batch_size = kw_batch_size * batch_multiplier
-    queued = Keyword.objects.filter(answered_at__isnull=True).filter(requested_at__isnull=False).count()
+    queued = get_value('keywords_pending')
 
     if queued + kw_batch_size >= max_queue:
         kw_batch_size = max(max_queue-queued, 0)
     
-    keyword_list = Keyword.objects.filter(requested_at=None)[:kw_batch_size]
     logger.info(f"Requesting responses for {kw_batch_size} keywords.")
+    lease_token, keyword_ids = claim_keywords(kw_batch_size)
 
-    # Remove batch size from keywords available to be queued and add to keywords pending stat
-    add_value('keywords_available', -kw_batch_size)
-    add_value('keywords_pending'  ,  kw_batch_size)
-
-    item_list = []
-    for keyword in keyword_list:
-        keyword.requested_at = timezone.now()
-        item_list.append(keyword)
-    Keyword.objects.bulk_update(item_list, ["requested_at"], batch_size=5000)
-
-    #Request responses for each keyword
-    for keyword in keyword_list:
-        prompt = "If a user searches for @currentKeyword, what is their user intent, how would you rephrase this as a natural language question, please provide a thorough and detailed answer to the natural language question, what was their likely previous query, and what could be their next query? Provide your response as a simple JSON object, with keys \"user_intent\", \"natural_language_question\", \"ai_answer\", \"likely_previous_queries\", and \"likely_next_queries\". If this is likely to be their first or last query in their journey, answer \"none\" in the field"
-        prompt = prompt.replace("@currentKeyword", keyword.keyword)
-        call_openai.apply_async( (prompt,), link=save_keyword_response.s(keyword.id)) #note the comma in arguments, critical to imply tuple, otherwise thinks array, passes response as first argument
-    
-    djmessages.success(request, f'Adding {len(item_list)} keywords to the queue')
+    #Request responses for each keyword, in batches handled by the async dispatcher
+    queue_keyword_batches(keyword_ids, lease_token)
+
+    djmessages.success(request, f'Adding {len(keyword_ids)} keywords to the queue')
     return redirect('keyword_list')
 
 def get_business_data(request):
@@ -156,7 +160,7 @@ def get_business_data(request):
         domain.business_retrieved_at = timezone.now()
         domain.save()
         prompt = f"For {domain.domain}, provide their Business Name, 6-digit NAICS code, Brands, Domains of Competitors, Products in a simple JSON object. In your response, use \"business_name\", \"naics_6\", \"company_brands\", \"competitor_domains\", and \"company_products\" as keys in the JSON."
-        call_openai.apply_async( (prompt,), link=save_business_json.s(domain.id))
+        call_openai.apply_async( (prompt,), {'expect_json': True}, link=save_business_json.s(domain.id))
     
     djmessages.success(request, f'Getting business data for {len(domain_list)} domains')
     return redirect('domain_list')
@@ -167,7 +171,7 @@ def index_brands(request):
     else:
         batch_size = 50
 
-    index_brands.apply_async( (batch_size,) )
+    index_brands_task.apply_async( (batch_size,) )
     
     djmessages.success(request, f'Requesting indexing for {batch_size} brands')
     return redirect('domain_list')
\ No newline at end of file
@@ -0,0 +1,138 @@
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from ranker.models import KeywordFile, PositionSnapshot, PositionUrl, SerpFeatureSet, KeywordIntentSet, upsert_keywords, upsert_lookup, update_keyword_trends, normalize_feature_set, keyword_import_lease
+
+import csv, io, datetime
+
+# Snapshot columns staged by COPY, in the order rows are written to the buffer
+SNAPSHOT_COLUMNS = [
+    'domain_id', 'keyword_id', 'retrieved_on', 'position', 'previous_position', 'search_volume', 'keyword_difficulty',
+    'cpc', 'traffic', 'traffic_percent', 'traffic_cost', 'competition', 'results', 'url_id', 'serp_features_id',
+    'intents_id', 'type',
+]
+
+# Merges staged rows into the history. One snapshot per domain, keyword and day: the best position wins within the
+# chunk, and re-importing a day replaces what was stored for it.
+MERGE_SNAPSHOTS_SQL = f"""
+    INSERT INTO ranker_positionsnapshot ({', '.join(SNAPSHOT_COLUMNS)})
+    SELECT DISTINCT ON (domain_id, keyword_id, retrieved_on) {', '.join(SNAPSHOT_COLUMNS)}
+    FROM position_import
+    ORDER BY domain_id, keyword_id, retrieved_on, position NULLS LAST
+    ON CONFLICT (domain_id, keyword_id, retrieved_on) DO UPDATE SET
+        {', '.join(f'{column} = EXCLUDED.{column}' for column in SNAPSHOT_COLUMNS[3:])}
+"""
+
+def parse_retrieved_at(value):
+    retrieved_at = parse_datetime(value or '')
+    if retrieved_at is None:
+        retrieved_date = parse_date(value or '')
+        if retrieved_date is None:
+            return timezone.now()
+        retrieved_at = datetime.datetime.combine(retrieved_date, datetime.time())
+    if timezone.is_naive(retrieved_at):
+        retrieved_at = timezone.make_aware(retrieved_at, timezone=datetime.timezone.utc)
+    return retrieved_at
+
+def parse_trends(value, retrieved_on):
+    # Semrush trends are 12 comma separated monthly values, oldest first, the last one being the month the data was
+    # retrieved. Returns (values, slope, peak month) or None when the field isn't a full 12 months.
+    try:
+        values = [float(part) for part in (value or '').split(',') if part.strip()]
+    except ValueError:
+        return None
+    if len(values) != 12:
+        return None
+    # Least squares slope over the month index, in trend units per month
+    mean_x = (len(values) - 1) / 2
+    mean_y = sum(values) / len(values)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / sum((x - mean_x) ** 2 for x in range(len(values)))
+    # Calendar month (1-12) of the first highest value
+    months_before_retrieval = len(values) - 1 - values.index(max(values))
+    peak_month = (retrieved_on.month - 1 - months_before_retrieval) % 12 + 1
+    return values, slope, peak_month
+
+# Semrush position types are free text; longer ones are cut to fit PositionSnapshot.type instead of failing the chunk
+POSITION_TYPE_LENGTH = PositionSnapshot._meta.get_field('type').max_length
+
+def import_rows(domain, rows):
+    # Imports one chunk of CSV rows: inserts new keywords and lookup values, resolving every id with one statement per
+    # table, then streams the snapshots to a staging table with COPY and merges them. Returns (keywords inserted, positions loaded).
+    # Total and available keyword statistics are updated by the keyword status trigger, counting only rows actually inserted
+    # Sorted, so parallel imports that share keywords take their row locks in the same order and can't deadlock
+    keyword_ids, inserted = upsert_keywords(sorted(set(row['Keyword'] for row in rows)))
+    url_ids = upsert_lookup(PositionUrl, 'url', [row['URL'] for row in rows if row['URL']])
+    serp_ids = upsert_lookup(SerpFeatureSet, 'features', filter(None, (normalize_feature_set(row['SERP Features by Keyword']) for row in rows)))
+    intent_ids = upsert_lookup(KeywordIntentSet, 'intents', filter(None, (normalize_feature_set(row['Keyword Intents']) for row in rows)))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    trends = {}
+    for row in rows:
+        retrieved_on = parse_retrieved_at(row.get('Timestamp')).astimezone(datetime.timezone.utc).date()
+        # Trends belong to the keyword, not the position; the newest one in the chunk is kept
+        keyword_trend = parse_trends(row.get('Trends'), retrieved_on)
+        keyword_id = keyword_ids[row['Keyword']]
+        if keyword_trend and (keyword_id not in trends or trends[keyword_id][0] <= retrieved_on):
+            trends[keyword_id] = (retrieved_on, *keyword_trend)
+        # Empty fields are written unquoted, which COPY reads as NULL
+        writer.writerow([
+            domain.id, keyword_id, retrieved_on.isoformat(),
+            row['Position'], row['Previous position'], row['Search Volume'], row['Keyword Difficulty'], row['CPC'],
+            row['Traffic'], row['Traffic (%)'], row['Traffic Cost'], row['Competition'], row['Number of Results'],
+            url_ids.get(row['URL']), serp_ids.get(normalize_feature_set(row['SERP Features by Keyword'])),
+            intent_ids.get(normalize_feature_set(row['Keyword Intents'])), (row['Position Type'] or '')[:POSITION_TYPE_LENGTH],
+        ])
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE position_import ON COMMIT DROP AS SELECT {', '.join(SNAPSHOT_COLUMNS)} FROM ranker_positionsnapshot WITH NO DATA")
+        cursor.copy_expert(f"COPY position_import ({', '.join(SNAPSHOT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(MERGE_SNAPSHOTS_SQL)
+    if trends:
+        update_keyword_trends(trends)
+    return inserted, len(rows)
+
+def import_keyword_file(file_id, chunk=5000):
+    # Imports one keyword file in a single streaming pass, holding one chunk of rows in memory at a time.
+    # rows_processed is saved in the same transaction as each chunk, so an interrupted import resumes after
+    # the last committed chunk instead of starting over. Returns (keywords inserted, positions loaded, seconds).
+    myfile = KeywordFile.objects.select_related('domain').get(id=file_id)
+    domain = myfile.domain
+    file_start = timezone.now()
+    resume_from = myfile.rows_processed
+    if resume_from:
+        print(f"Resuming {myfile.filepath.name} after row {resume_from}")
+
+    def import_chunk(rows, offset):
+        with transaction.atomic():
+            inserted, loaded = import_rows(domain, rows)
+            KeywordFile.objects.filter(id=myfile.id).update(rows_processed=offset, import_lease_expires_at=keyword_import_lease())
+        return inserted, loaded
+
+    keywords_inserted = 0
+    positions_loaded = 0
+    with myfile.filepath.open(mode='r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        rows = []
+        offset = 0
+        for row in reader:
+            offset += 1
+            if offset <= resume_from:
+                continue
+            rows.append(row)
+            if len(rows) >= chunk:
+                inserted, loaded = import_chunk(rows, offset)
+                keywords_inserted += inserted
+                positions_loaded += loaded
+                rows = []
+        if rows:
+            inserted, loaded = import_chunk(rows, offset)
+            keywords_inserted += inserted
+            positions_loaded += loaded
+
+    file_stop = timezone.now()
+    seconds = (file_stop-file_start).total_seconds()
+    KeywordFile.objects.filter(id=myfile.id).update(processed_at=file_stop)
+    print(f"Loading {myfile.filepath.name} took: {seconds} seconds. {keywords_inserted} new keywords, {positions_loaded} positions ({int(positions_loaded / max(seconds, 0.001))} rows/sec).")
+    return keywords_inserted, positions_loaded, seconds
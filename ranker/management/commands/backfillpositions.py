@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Min, Max
+from django.utils import timezone
+
+from ranker.models import KeywordPosition, update_keyword_trends
+from ranker.importing import parse_trends
+
+import datetime
+
+# Same normalization as normalize_feature_set: trimmed, de-duplicated, sorted by code point, comma joined, NULL when empty
+def feature_set_sql(column):
+    return f"""NULLIF(array_to_string(ARRAY(
+        SELECT DISTINCT trim(part) COLLATE "C" FROM unnest(string_to_array({column}, ',')) AS part WHERE trim(part) <> '' ORDER BY 1
+    ), ','), '')"""
+
+class Command(BaseCommand):
+    help = "Copies KeywordPosition rows into the normalized PositionSnapshot history, and their trends onto keywords"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk', action='store', type=int, default=100000, help="KeywordPosition ids copied per transaction")
+
+    def handle(self, *args, **options):
+        #handle is a special method that the django manage command will run, with the args and options provided
+        start_time = timezone.now()
+        bounds = KeywordPosition.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            raise CommandError("No keyword positions to backfill.")
+
+        # Everything is set based: each id range adds its missing lookup values, then copies its rows joined to them.
+        # Rows already in the history (same domain, keyword and day) are left alone, so the command can be rerun.
+        copied = 0
+        for start_id in range(bounds['min_id'], bounds['max_id'] + 1, options['chunk']):
+            end_id = start_id + options['chunk']
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO ranker_positionurl (url)
+                    SELECT DISTINCT url FROM ranker_keywordposition WHERE id >= %s AND id < %s AND url <> ''
+                    ON CONFLICT (url) DO NOTHING
+                """, [start_id, end_id])
+                cursor.execute(f"""
+                    INSERT INTO ranker_serpfeatureset (features)
+                    SELECT DISTINCT {feature_set_sql('serp')} FROM ranker_keywordposition
+                    WHERE id >= %s AND id < %s AND {feature_set_sql('serp')} IS NOT NULL
+                    ON CONFLICT (features) DO NOTHING
+                """, [start_id, end_id])
+                cursor.execute(f"""
+                    INSERT INTO ranker_keywordintentset (intents)
+                    SELECT DISTINCT {feature_set_sql('intents')} FROM ranker_keywordposition
+                    WHERE id >= %s AND id < %s AND {feature_set_sql('intents')} IS NOT NULL
+                    ON CONFLICT (intents) DO NOTHING
+                """, [start_id, end_id])
+                cursor.execute(f"""
+                    INSERT INTO ranker_positionsnapshot (
+                        domain_id, keyword_id, retrieved_on, position, previous_position, search_volume, keyword_difficulty,
+                        cpc, traffic, traffic_percent, traffic_cost, competition, results, url_id, serp_features_id, intents_id, type
+                    )
+                    SELECT DISTINCT ON (p.domain_id, p.keyword_id, (COALESCE(p.retrieved_at, p.created_at) AT TIME ZONE 'UTC')::date)
+                        p.domain_id, p.keyword_id, (COALESCE(p.retrieved_at, p.created_at) AT TIME ZONE 'UTC')::date,
+                        p.position, p.previous_position, p.search_volume, p.keyword_difficulty, p.cpc, p.traffic,
+                        p.traffic_percent, p.traffic_cost, p.competitive_difficulty, p.results, u.id, s.id, i.id, left(p.type, 40)
+                    FROM ranker_keywordposition p
+                    LEFT JOIN ranker_positionurl u ON u.url = p.url
+                    LEFT JOIN ranker_serpfeatureset s ON s.features = {feature_set_sql('p.serp')}
+                    LEFT JOIN ranker_keywordintentset i ON i.intents = {feature_set_sql('p.intents')}
+                    WHERE p.id >= %s AND p.id < %s AND p.domain_id IS NOT NULL AND p.keyword_id IS NOT NULL
+                    ORDER BY p.domain_id, p.keyword_id, (COALESCE(p.retrieved_at, p.created_at) AT TIME ZONE 'UTC')::date, p.position NULLS LAST
+                    ON CONFLICT (domain_id, keyword_id, retrieved_on) DO NOTHING
+                """, [start_id, end_id])
+                copied += cursor.rowcount
+
+                # Trends are parsed the same way the importer does; the newest position for each keyword wins
+                trends = {}
+                positions = KeywordPosition.objects.filter(id__gte=start_id, id__lt=end_id, keyword__isnull=False, trends__isnull=False)
+                for keyword_id, value, retrieved_at, created_at in positions.values_list('keyword_id', 'trends', 'retrieved_at', 'created_at').iterator():
+                    retrieved_on = (retrieved_at or created_at).astimezone(datetime.timezone.utc).date()
+                    keyword_trend = parse_trends(value, retrieved_on)
+                    if keyword_trend and (keyword_id not in trends or trends[keyword_id][0] <= retrieved_on):
+                        trends[keyword_id] = (retrieved_on, *keyword_trend)
+                if trends:
+                    update_keyword_trends(trends)
+            print(f"[{timezone.now()}] Backfilled keyword positions up to id {min(end_id - 1, bounds['max_id'])} of {bounds['max_id']}: {copied} snapshots")
+
+        end_time = timezone.now()
+        self.stdout.write(f"Backfilling {copied} snapshots took: {(end_time-start_time).total_seconds()} seconds.")
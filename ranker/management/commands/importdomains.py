@@ -1,73 +1,93 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 from django.utils import timezone
 
 from ranker.models import Domain
 
-import csv
+import csv, io
+
+# Ranking columns, in file order. Everything is staged as text and cast during the merge.
+DOMAIN_COLUMNS = ['rank', 'domain', 'keywords', 'traffic', 'cost', 'ad_keywords', 'ad_traffic', 'ad_cost']
+
+MERGE_SQL = """
+    WITH merged AS (
+        INSERT INTO ranker_domain (domain, rank, keywords, traffic, cost, ad_keywords, ad_traffic, ad_cost, adult_content, business_attempts, created_at, updated_at)
+        SELECT DISTINCT ON (domain)
+            domain, NULLIF(rank, '')::integer, NULLIF(keywords, '')::bigint, NULLIF(traffic, '')::bigint, NULLIF(cost, '')::numeric,
+            NULLIF(ad_keywords, '')::bigint, NULLIF(ad_traffic, '')::bigint, NULLIF(ad_cost, '')::numeric,
+            COALESCE(NULLIF(ad_keywords, '')::bigint = 0, false), 0, now(), now()
+        FROM domain_import
+        ORDER BY domain, NULLIF(rank, '')::integer
+        ON CONFLICT (domain) DO UPDATE SET
+            rank = EXCLUDED.rank, keywords = EXCLUDED.keywords, traffic = EXCLUDED.traffic, cost = EXCLUDED.cost,
+            ad_keywords = EXCLUDED.ad_keywords, ad_traffic = EXCLUDED.ad_traffic, ad_cost = EXCLUDED.ad_cost,
+            adult_content = EXCLUDED.adult_content, updated_at = now()
+        WHERE (ranker_domain.rank, ranker_domain.keywords, ranker_domain.traffic, ranker_domain.cost, ranker_domain.ad_keywords,
+               ranker_domain.ad_traffic, ranker_domain.ad_cost, ranker_domain.adult_content)
+            IS DISTINCT FROM
+              (EXCLUDED.rank, EXCLUDED.keywords, EXCLUDED.traffic, EXCLUDED.cost, EXCLUDED.ad_keywords,
+               EXCLUDED.ad_traffic, EXCLUDED.ad_cost, EXCLUDED.adult_content)
+        RETURNING xmax = 0 AS inserted
+    )
+    SELECT
+        (SELECT COUNT(DISTINCT domain) FROM domain_import),
+        COUNT(*) FILTER (WHERE inserted),
+        COUNT(*) FILTER (WHERE NOT inserted)
+    FROM merged
+"""
 
 class Command(BaseCommand):
-    help = "import a list of domains at first launch"
+    help = "import a list of domains at first launch, or refresh the rankings of an existing list"
 
     def add_arguments(self, parser):
-        parser.add_argument('file_path', nargs=1, type=str) 
+        parser.add_argument('file_path', nargs=1, type=str)
         #This is a positional argument, which, since added first, evaluates the first word to come after the command
         # The nargs='+' command says to take every word in the command and combine it together into a list and error if no words are found
+        parser.add_argument('--refresh', action='store_true', help="Merge the file into existing domains, updating rankings that changed")
+        parser.add_argument('--chunk', action='store', type=int, default=100000, help="Rows sent per COPY")
 
     def handle(self, *args, **options):
         #handle is a special method that the django manage command will run, with the args and options provided
 
-        if Domain.objects.count() > 0:
-            self.stderr.write(f"There are already {Domain.objects.count()} domains in the database. Skipping import.")
+        if not options['refresh'] and Domain.objects.exists():
+            self.stderr.write(f"There are already {Domain.objects.count()} domains in the database. Skipping import. Use --refresh to update them.")
             return
 
         myfile = options["file_path"][0]
         start_time = timezone.now()
 
-        with open(myfile, "r") as csv_file: #with replaces a try/finally syntax and ensures all files that are opened are closed and resources released.
-            data = csv.reader(csv_file, delimiter=",")
-            domains = []
-            next(data) #Skip header row
-            def maybe_int(val):
-                try:
-                    return int(val)
-                except:
-                    return val
-            for row in data:
-                if maybe_int(row[5]) == 0:
-                    adult = True
-                else:
-                    adult = False 
-                domain = Domain(
-                    rank=row[0],
-                    domain=row[1],
-                    keywords=row[2],
-                    traffic=row[3],
-                    cost=row[4],
-                    ad_keywords=row[5],
-                    ad_traffic=row[6],
-                    ad_cost=row[7],
-                    adult_content = adult
-                )
-                domains.append(domain)
-                if len(domains) > 5000:
-                    Domain.objects.bulk_create(domains
-                            , update_conflicts=True
-                            , update_fields=["rank", "keywords", "traffic", "cost", "ad_keywords", "ad_traffic", "ad_cost", "adult_content"]
-                            , unique_fields=["domain"]
-                    )
-                    self.stdout.write(f"Bulk upsert completed: {len(domains)} records")
-                    domains = []
-            if domains:
-                    Domain.objects.bulk_create(domains
-                            , update_conflicts=True
-                            , update_fields=["rank", "keywords", "traffic", "cost", "ad_keywords", "ad_traffic", "ad_cost", "adult_content"]
-                            , unique_fields=["domain"]
-                    )
-            self.stdout.write(f"Bulk upsert completed: {len(domains)} records")
-        
+        # The file is streamed into a temp table with COPY, then merged into ranker_domain with one INSERT ... ON CONFLICT.
+        # Rows whose values didn't change aren't rewritten, so a monthly refresh only touches what moved.
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"CREATE TEMP TABLE domain_import ({', '.join(f'{column} text' for column in DOMAIN_COLUMNS)}) ON COMMIT DROP")
+            copy_sql = f"COPY domain_import ({', '.join(DOMAIN_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+            with open(myfile, "r") as csv_file: #with replaces a try/finally syntax and ensures all files that are opened are closed and resources released.
+                data = csv.reader(csv_file, delimiter=",")
+                next(data) #Skip header row
+                staged = 0
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in data:
+                    writer.writerow(row[:len(DOMAIN_COLUMNS)])
+                    staged += 1
+                    if staged % options['chunk'] == 0:
+                        buffer.seek(0)
+                        cursor.copy_expert(copy_sql, buffer)
+                        buffer = io.StringIO()
+                        writer = csv.writer(buffer)
+                        self.stdout.write(f"Staged {staged} records")
+                buffer.seek(0)
+                cursor.copy_expert(copy_sql, buffer)
+            self.stdout.write(f"Staged {staged} records")
+
+            cursor.execute(MERGE_SQL)
+            total, inserted, updated = cursor.fetchone()
+
         end_time = timezone.now()
+        self.stdout.write(f"Domains: {inserted} inserted, {updated} updated, {total - inserted - updated} unchanged")
         self.stdout.write(
             self.style.SUCCESS(
                 f"Loading CSV took: {(end_time-start_time).total_seconds()} seconds."
             )
-        )
\ No newline at end of file
+        )
@@ -1,26 +1,20 @@
 from django.core.management.base import BaseCommand, CommandError
-from django.utils import timezone, html
+from django.db import connection
+from django.utils import timezone
 
-from ranker.models import Domain, TokenType, Token, Template, TemplateItem, Conversation, Message, KeywordFile, Keyword, KeywordPosition, Statistic, add_value
-from ranker.tasks import call_openai, save_keyword_response
+from ranker.models import KeywordFile
+from ranker.importing import import_keyword_file
 
-import os, openai, markdown, json, csv
-
-import asyncio
-import concurrent.futures              # Allows creating new processes
-from math import ceil, floor           # Helps divide up our requests evenly across our CPU cores
-from multiprocessing import cpu_count  # Returns our number of CPU cores
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_random_exponential,
-)  # for exponential backoff
+import concurrent.futures
+import multiprocessing
 
 class Command(BaseCommand):
     help = "Import keywords from all primary files that have not yet been processed."
 
     def add_arguments(self, parser):
         parser.add_argument('--kwfile', action='store', type=int)
+        parser.add_argument('--chunk', action='store', type=int, default=5000, help="Rows imported per batch")
+        parser.add_argument('--workers', action='store', type=int, default=1, help="Number of files imported at once, each in its own process")
 
 
     def handle(self, *args, **options):
@@ -30,78 +24,29 @@ class Command(BaseCommand):
             files = KeywordFile.objects.filter(id__exact=options['kwfile']).filter(primary=True).filter(processed_at=None)
         else:
             files = KeywordFile.objects.filter(primary=True).filter(processed_at=None)
-
-        for myfile in files:
-            domain = myfile.domain
-            file_start = timezone.now()
-
-            #Read in Keywords from file
-            with myfile.filepath.open(mode='r') as csvfile:
-                item_list = []
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    item = Keyword( 
-                        keyword = row['Keyword'],
-                    )
-                    item_list.append(item)
-                Keyword.objects.bulk_create(item_list, ignore_conflicts=True)
-                # Add new keywords to total keywords and available keywords statistics
-                add_value('keywords_total'    , len(item_list))
-                add_value('keywords_available', len(item_list))
-
-                self.stdout.write(f"Bulk insert completed: {len(item_list)} {type(item_list[0]).__name__} records")
-
-            #Save original data in case useful later
-            keyword_position_list = []
-            with myfile.filepath.open(mode='r') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    keyword = Keyword.objects.get(keyword = row['Keyword'])
+        file_ids = list(files.values_list('id', flat=True))
+
+        if options['workers'] > 1 and len(file_ids) > 1:
+            # Children must open their own database connections
+            connection.close()
+            context = multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(max_workers=options['workers'], mp_context=context) as executor:
+                futures = {executor.submit(import_keyword_file, file_id, options['chunk']): file_id for file_id in file_ids}
+                results = []
+                for future in concurrent.futures.as_completed(futures):
                     try:
-                         retrieved_at = timezone.make_aware(row['Timestamp'], timezone=timezone.utc)
-                    except:
-                         retrieved_at = timezone.now()
-                    keyword_position = KeywordPosition(
-                        domain      = domain,
-                        keyword     = keyword,
-                        domain_text = domain.domain,
-                        keyword_text        = row['Keyword'],
-                        position            = row['Position'],
-                        previous_position   = row['Previous position'],
-                        search_volume       = row['Search Volume'],
-                        keyword_difficulty  = row['Keyword Difficulty'],
-                        cpc                 = row['CPC'],
-                        url                 = row['URL'],
-                        traffic             = row['Traffic'],
-                        traffic_percent     = row['Traffic (%)'],
-                        traffic_cost        = row['Traffic Cost'],
-                        competitive_difficulty = row['Competition'],
-                        results             = row['Number of Results'],
-                        trends              = row['Trends'],
-                        retrieved_at        = retrieved_at,
-                        serp                = row['SERP Features by Keyword'],
-                        intents             = row['Keyword Intents'],
-                        type                = row['Position Type'],
-                    )
-                    keyword_position_list.append(keyword_position)
-                    if len(keyword_position_list) > 5000:
-                        KeywordPosition.objects.bulk_create(keyword_position_list, ignore_conflicts=True)
-                        self.stdout.write(f"Bulk insert completed: {len(keyword_position_list)} records")
-                        keyword_position_list = []
-                if keyword_position_list:
-                        KeywordPosition.objects.bulk_create(keyword_position_list, ignore_conflicts=True)
-                self.stdout.write(f"Bulk upsert completed: {len(keyword_position_list)} records")
-            
-            file_stop = timezone.now()
-            myfile.processed_at = file_stop
-            myfile.save()
-            self.stdout.write(f"Loading {myfile.filepath.name} took: {(file_stop-file_start).total_seconds()} seconds.")
+                        results.append(future.result())
+                    except Exception as e:
+                        # The file keeps its checkpoint, so running the command again resumes it
+                        self.stderr.write(f"Importing keyword file {futures[future]} failed: {repr(e)}")
+        else:
+            results = [import_keyword_file(file_id, options['chunk']) for file_id in file_ids]
 
         end_time = timezone.now()
+        positions_loaded = sum(loaded for inserted, loaded, seconds in results)
         self.stdout.write(
             self.style.SUCCESS(
-                f"Loading all {len(files)} files took: {(end_time-start_time).total_seconds()} seconds."
+                f"Loading {len(results)} of {len(file_ids)} files took: {(end_time-start_time).total_seconds()} seconds. "
+                f"{positions_loaded} positions ({int(positions_loaded / max((end_time-start_time).total_seconds(), 0.001))} rows/sec)."
             )
         )
-
-        
\ No newline at end of file
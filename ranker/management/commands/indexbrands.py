@@ -1,46 +1,83 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Min, Max
 from django.utils import timezone
 
 from ranker.models import Brand, BrandKeyword, Keyword
+from ranker.matching import BrandMatcher, brand_pattern
 
-import csv
+import multiprocessing
+
+# Set before worker processes fork, so each one inherits the compiled automaton instead of rebuilding or unpickling it
+matcher = None
+
+def index_keyword_range(id_range, chunk=5000, batch_size=10000):
+    # One streaming pass over the answers in [start_id, end_id), writing brand links in bulk as they accumulate
+    start_id, end_id = id_range
+    answers = Keyword.objects.filter(ai_answer__isnull=False, id__gte=start_id, id__lt=end_id).values_list('id', 'ai_answer')
+    links = []
+    linked = 0
+    for keyword_id, ai_answer in answers.iterator(chunk_size=chunk):
+        for brand_id in matcher.matches(f" {ai_answer.lower()} "):
+            links.append(BrandKeyword(brand_id=brand_id, keyword_id=keyword_id))
+        if len(links) >= batch_size:
+            BrandKeyword.objects.bulk_create(links, ignore_conflicts=True)
+            linked += len(links)
+            links = []
+    BrandKeyword.objects.bulk_create(links, ignore_conflicts=True)
+    linked += len(links)
+    print(f"[{timezone.now()}] Keywords {start_id} to {end_id - 1}: {linked} brand matches")
+    return linked
 
 class Command(BaseCommand):
-    help = "import a list of domains at first launch"
+    help = "Matches unindexed brands against every keyword answer and links them"
 
     def add_arguments(self, parser):
-        parser.add_argument('--batch', action='store', type=int)
+        parser.add_argument('--batch', action='store', type=int, help="Number of unindexed brands to match")
+        parser.add_argument('--start-id', action='store', type=int, help="First keyword id to scan")
+        parser.add_argument('--end-id', action='store', type=int, help="Last keyword id to scan")
+        parser.add_argument('--processes', action='store', type=int, default=1, help="Number of worker processes, each scanning its own keyword id range")
+        parser.add_argument('--chunk', action='store', type=int, default=100000, help="Keyword ids per unit of work")
 
-        # parser.add_argument('file_path', nargs=1, type=str) 
+        # parser.add_argument('file_path', nargs=1, type=str)
         #This is a positional argument, which, since added first, evaluates the first word to come after the command
         # The nargs='+' command says to take every word in the command and combine it together into a list and error if no words are found
 
     def handle(self, *args, **options):
         #handle is a special method that the django manage command will run, with the args and options provided
+        global matcher
 
         batch_size = options["batch"]
         print(f'[{timezone.now()}] Batch size: {batch_size}')
-        brand_list = Brand.objects.filter(keyword_indexed_at__isnull=True)[:batch_size]
+        brand_list = list(Brand.objects.filter(keyword_indexed_at__isnull=True).values_list('id', 'brand')[:batch_size])
         print(f"[{timezone.now()}] Found {len(brand_list)} brands")
-        keyword_list = Keyword.objects.filter(ai_answer__isnull=False)
-        print(f"[{timezone.now()}] Pulled {len(keyword_list)} keywords")
-        for keyword in keyword_list:
-            if keyword.ai_answer:
-                keyword.ai_answer = keyword.ai_answer.lower()
-        print(f"[{timezone.now()}] Lowercased all keywords")
-
-        i = 0
-        for brand in brand_list:
-            i += 1
-            start_time = timezone.now()
-            brand.indexing_requested_at = start_time
-            add_keywords=[]
-            for keyword in keyword_list:
-                if (' ' + brand.brand.lower() + ' ') in keyword.ai_answer:
-                    add_keywords.append(keyword)
-            if len(add_keywords) > 0:
-                brand.keyword.add(*add_keywords)
-            end_time = timezone.now()
-            brand.keyword_indexed_at = end_time
-            brand.save()
-            print(f"({i}/{len(brand_list)} - {int((end_time-start_time).total_seconds())} sec - {timezone.now()}) Brand ID {brand.pk} ({brand.brand}): {len(add_keywords)} keywords updated")
\ No newline at end of file
+        if not brand_list:
+            return
+
+        # Every brand goes into one automaton, so each answer is scanned once no matter how many brands there are
+        start_time = timezone.now()
+        matcher = BrandMatcher({brand_pattern(brand): brand_id for brand_id, brand in brand_list})
+        Brand.objects.filter(id__in=[brand_id for brand_id, brand in brand_list]).update(indexing_requested_at=start_time)
+        print(f"[{timezone.now()}] Compiled matcher for {len(brand_list)} brands")
+
+        # A partial id range can be run on several machines at once. Brands are only marked indexed after a full scan.
+        bounds = Keyword.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            raise CommandError("No keywords to index.")
+        full_scan = options['start_id'] is None and options['end_id'] is None
+        start_id = options['start_id'] if options['start_id'] is not None else bounds['min_id']
+        end_id = (options['end_id'] if options['end_id'] is not None else bounds['max_id']) + 1
+        id_ranges = [(i, min(i + options['chunk'], end_id)) for i in range(start_id, end_id, options['chunk'])]
+
+        if options['processes'] > 1:
+            # Children must open their own database connections
+            connection.close()
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                linked = sum(pool.imap_unordered(index_keyword_range, id_ranges))
+        else:
+            linked = sum(index_keyword_range(id_range) for id_range in id_ranges)
+
+        end_time = timezone.now()
+        if full_scan:
+            Brand.objects.filter(id__in=[brand_id for brand_id, brand in brand_list]).update(keyword_indexed_at=end_time)
+        print(f"({int((end_time-start_time).total_seconds())} sec - {timezone.now()}) {len(brand_list)} brands: {linked} keyword matches")
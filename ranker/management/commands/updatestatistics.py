@@ -1,51 +1,63 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, OperationalError
 from django.utils import timezone
 
-from ranker.models import Keyword, Statistic
+from ranker.models import get_values, set_value
+
+KEYWORD_STATISTICS = ['keywords_total', 'keywords_available', 'keywords_pending', 'keywords_answered']
 
 class Command(BaseCommand):
-    help = "Updates keyword statistics"
+    help = "Verifies keyword statistics against the keyword table and optionally repairs drift"
 
-    # def add_arguments(self, parser):
-    #     parser.add_argument('file_path', nargs=1, type=str) 
-        #This is a positional argument, which, since added first, evaluates the first word to come after the command
-        # The nargs='+' command says to take every word in the command and combine it together into a list and error if no words are found
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help="Overwrite statistics that don't match the counted values")
+        parser.add_argument('--chunk', action='store', type=int, default=100000, help="Number of keyword ids counted per query")
 
     def handle(self, *args, **options):
         #handle is a special method that the django manage command will run, with the args and options provided
 
-        # Consider wrapping each of these in a transaction.atomic and selecting with select_for_update()
-        # Con is that it will lock the entire Keywords table for 3+ minutes, but will prevent keywords from being added/updated while stat is calculated
-
-        print("Starting to update statistics. This historically takes around 3 minutes for each of the larger statistics.")
-
-        #Update total keywords
-        # keywords_total = Keyword.objects.all().count()
-        # keywords_total_stat = Statistic.objects.get(key="keywords_total")
-        # keywords_total_stat.value = keywords_total
-        # keywords_total_stat.save()
-        # print(f"Total keywords updated. ({keywords_total_stat.value})")
-
-        #Update available keywords
-        keywords_available = Keyword.objects.filter(answered_at__isnull=True).filter(requested_at__isnull=True).count()
-        keywords_available_stat = Statistic.objects.get(key="keywords_available")
-        keywords_available_stat.value = keywords_available
-        keywords_available_stat.save()
-        print(f"Available keywords updated. ({keywords_available_stat.value})")
-
-        #Update pending keywords
-        keywords_pending = Keyword.objects.filter(answered_at__isnull=True).filter(requested_at__isnull=False).count()
-        keywords_pending_stat = Statistic.objects.get(key="keywords_pending")
-        keywords_pending_stat.value = keywords_pending
-        keywords_pending_stat.save()
-        print(f"Pending keywords updated. ({keywords_pending_stat.value})")
-
-        #Update answered keywords
-        # keywords_answered = Keyword.objects.filter(answered_at__isnull=False).count()
-        # keywords_answered_stat = Statistic.objects.get(key="keywords_answered")
-        # keywords_answered_stat.value = keywords_answered
-        # keywords_answered_stat.save()
-        # print(f"Keywords answered updated. ({keywords_answered_stat.value})")
-
-
-
+        # The keyword status trigger keeps these statistics current, so this only needs to run to check for or fix drift.
+        # Everything runs in one repeatable read transaction: the counts and the statistics come from the same snapshot,
+        # so they can be compared exactly while keywords keep changing. Counting is split into id ranges so each query stays
+        # small and progress is visible. If a concurrent compaction touches the rows being repaired, the repair is retried.
+        for attempt in range(3):
+            try:
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                    self.verify(options['chunk'], options['repair'])
+                return
+            except OperationalError as e:
+                print(f"Statistics changed during repair, retrying. ({e})")
+        raise CommandError("Couldn't repair statistics after 3 attempts.")
+
+    def verify(self, chunk, repair):
+        start_time = timezone.now()
+        counted = dict.fromkeys(KEYWORD_STATISTICS, 0)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM ranker_keyword")
+            min_id, max_id = cursor.fetchone()
+            for start_id in range(min_id, max_id + 1, chunk):
+                cursor.execute("""
+                    SELECT  COUNT(*),
+                            COUNT(*) FILTER (WHERE status = 'available'),
+                            COUNT(*) FILTER (WHERE status = 'pending'),
+                            COUNT(*) FILTER (WHERE status = 'answered')
+                    FROM ranker_keyword WHERE id >= %s AND id < %s
+                """, [start_id, start_id + chunk])
+                for key, count in zip(KEYWORD_STATISTICS, cursor.fetchone()):
+                    counted[key] += count
+                print(f"[{timezone.now()}] Counted keywords up to id {min(start_id + chunk - 1, max_id)} of {max_id}")
+
+        stored = get_values(*KEYWORD_STATISTICS)
+        for key in KEYWORD_STATISTICS:
+            if stored[key] == counted[key]:
+                print(f"{key}: {counted[key]} (ok)")
+            elif repair:
+                set_value(key, counted[key])
+                print(f"{key}: {stored[key]} -> {counted[key]} (repaired)")
+            else:
+                print(f"{key}: stored {stored[key]}, counted {counted[key]} (drift of {stored[key] - counted[key]}, run with --repair to fix)")
+
+        end_time = timezone.now()
+        self.stdout.write(f"Verifying statistics took: {(end_time-start_time).total_seconds()} seconds.")
@@ -0,0 +1,62 @@
+from collections import deque
+
+# Aho-Corasick automaton for finding many brand names in text with one pass per text, however many brands there are.
+# Patterns are plain strings; matching is exact, so callers normalize (lowercase, pad with spaces) both sides first.
+class BrandMatcher:
+    def __init__(self, patterns):
+        # patterns is {pattern: value}; matches() returns the values of every pattern found
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        self.output_link = [0]
+        for pattern, value in patterns.items():
+            if pattern:
+                self.add(pattern, value)
+        self.build()
+
+    def add(self, pattern, value):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.output_link.append(0)
+            state = next_state
+        self.output[state].append(value)
+
+    def build(self):
+        # Breadth first, so each state's failure link points at an already finished shallower state.
+        # output_link skips straight to the nearest suffix state that ends a pattern, so outputs aren't copied around.
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                suffix = self.fail[next_state]
+                self.output_link[next_state] = suffix if self.output[suffix] else self.output_link[suffix]
+
+    def matches(self, text):
+        found = set()
+        goto, fail, output, output_link = self.goto, self.fail, self.output, self.output_link
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match_state = state if output[state] else output_link[state]
+            while match_state:
+                found.update(output[match_state])
+                match_state = output_link[match_state]
+        return found
+
+def brand_pattern(brand):
+    # Same rule the indexer has always used: the brand as a whole, space delimited phrase in the lowercased answer
+    return f" {brand.lower()} "
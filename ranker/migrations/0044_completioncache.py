@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0043_answer_unique_answer_ai_model_keyword'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('ai_model', models.CharField(max_length=200)),
+                ('temperature', models.FloatField()),
+                ('prompt', models.TextField()),
+                ('response', models.TextField()),
+                ('hits', models.IntegerField(default=0)),
+                ('used_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='ranker_comp_created_395a49_idx'), models.Index(fields=['used_at'], name='ranker_comp_used_at_32cae1_idx')],
+            },
+        ),
+    ]
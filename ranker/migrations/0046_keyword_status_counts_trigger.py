@@ -0,0 +1,78 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:02
+
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ranker", "0045_statisticdelta"),
+    ]
+
+    # Keeps keywords_total/available/pending/answered exact without COUNT(*) scans. One statement-level trigger per event
+    # reads the transition tables, works out how many rows left and entered each state, and appends the net change
+    # to ranker_statisticdelta in the same transaction as the keyword write.
+    operations = [
+        migrations.RunSQL(
+            sql='''
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_key(answered_at timestamptz, requested_at timestamptz)
+              RETURNS varchar AS $$
+                SELECT CASE
+                  WHEN answered_at IS NOT NULL THEN 'keywords_answered'
+                  WHEN requested_at IS NOT NULL THEN 'keywords_pending'
+                  ELSE 'keywords_available'
+                END
+              $$ LANGUAGE sql IMMUTABLE;
+
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_counts()
+              RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'INSERT' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, 1 AS amount FROM new_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', 1 FROM new_keywords
+                  ) changes GROUP BY key;
+                ELSIF TG_OP = 'UPDATE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT ranker_keyword_status_key(answered_at, requested_at), 1 FROM new_keywords
+                  ) changes GROUP BY key HAVING SUM(amount) <> 0;
+                ELSIF TG_OP = 'DELETE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', -1 FROM old_keywords
+                  ) changes GROUP BY key;
+                END IF;
+                RETURN NULL;
+              END;
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER keyword_status_counts_insert
+              AFTER INSERT ON ranker_keyword
+              REFERENCING NEW TABLE AS new_keywords
+              FOR EACH STATEMENT EXECUTE FUNCTION ranker_keyword_status_counts();
+
+              CREATE TRIGGER keyword_status_counts_update
+              AFTER UPDATE ON ranker_keyword
+              REFERENCING OLD TABLE AS old_keywords NEW TABLE AS new_keywords
+              FOR EACH STATEMENT EXECUTE FUNCTION ranker_keyword_status_counts();
+
+              CREATE TRIGGER keyword_status_counts_delete
+              AFTER DELETE ON ranker_keyword
+              REFERENCING OLD TABLE AS old_keywords
+              FOR EACH STATEMENT EXECUTE FUNCTION ranker_keyword_status_counts();
+            ''',
+
+            reverse_sql = '''
+              DROP TRIGGER IF EXISTS keyword_status_counts_insert ON ranker_keyword;
+              DROP TRIGGER IF EXISTS keyword_status_counts_update ON ranker_keyword;
+              DROP TRIGGER IF EXISTS keyword_status_counts_delete ON ranker_keyword;
+              DROP FUNCTION IF EXISTS ranker_keyword_status_counts();
+              DROP FUNCTION IF EXISTS ranker_keyword_status_key(timestamptz, timestamptz);
+            '''
+        ),
+    ]
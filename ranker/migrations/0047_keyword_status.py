@@ -0,0 +1,113 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0046_keyword_status_counts_trigger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='status',
+            field=models.CharField(choices=[('available', 'available'), ('pending', 'pending'), ('answered', 'answered')], default='available', max_length=20),
+        ),
+        # Backfill the new column from the timestamps. The counts trigger still derives state from the timestamps here,
+        # so the backfill nets to zero; afterwards the trigger is switched to read the status column.
+        migrations.RunSQL(
+            sql='''
+              UPDATE ranker_keyword SET status = 'answered' WHERE answered_at IS NOT NULL;
+              UPDATE ranker_keyword SET status = 'pending' WHERE answered_at IS NULL AND requested_at IS NOT NULL;
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql='''
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_counts()
+              RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'INSERT' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT 'keywords_' || status AS key, 1 AS amount FROM new_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', 1 FROM new_keywords
+                  ) changes GROUP BY key;
+                ELSIF TG_OP = 'UPDATE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT 'keywords_' || status AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT 'keywords_' || status, 1 FROM new_keywords
+                  ) changes GROUP BY key HAVING SUM(amount) <> 0;
+                ELSIF TG_OP = 'DELETE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT 'keywords_' || status AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', -1 FROM old_keywords
+                  ) changes GROUP BY key;
+                END IF;
+                RETURN NULL;
+              END;
+              $$ LANGUAGE plpgsql;
+
+              DROP FUNCTION IF EXISTS ranker_keyword_status_key(timestamptz, timestamptz);
+            ''',
+
+            reverse_sql = '''
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_key(answered_at timestamptz, requested_at timestamptz)
+              RETURNS varchar AS $$
+                SELECT CASE
+                  WHEN answered_at IS NOT NULL THEN 'keywords_answered'
+                  WHEN requested_at IS NOT NULL THEN 'keywords_pending'
+                  ELSE 'keywords_available'
+                END
+              $$ LANGUAGE sql IMMUTABLE;
+
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_counts()
+              RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'INSERT' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, 1 AS amount FROM new_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', 1 FROM new_keywords
+                  ) changes GROUP BY key;
+                ELSIF TG_OP = 'UPDATE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT ranker_keyword_status_key(answered_at, requested_at), 1 FROM new_keywords
+                  ) changes GROUP BY key HAVING SUM(amount) <> 0;
+                ELSIF TG_OP = 'DELETE' THEN
+                  INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                  SELECT key, SUM(amount), now() FROM (
+                    SELECT ranker_keyword_status_key(answered_at, requested_at) AS key, -1 AS amount FROM old_keywords
+                    UNION ALL
+                    SELECT 'keywords_total', -1 FROM old_keywords
+                  ) changes GROUP BY key;
+                END IF;
+                RETURN NULL;
+              END;
+              $$ LANGUAGE plpgsql;
+            '''
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(models.OrderBy(models.F('priority'), descending=True, nulls_last=True), models.OrderBy(models.F('search_volume'), descending=True, nulls_last=True), models.F('id'), condition=models.Q(('status', 'available')), name='idx_keyword_available_queue'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['requested_at'], name='idx_keyword_pending'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(('status', 'answered')), fields=['answered_at'], name='idx_keyword_answered'),
+        ),
+    ]
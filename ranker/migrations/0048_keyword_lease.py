@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0047_keyword_status'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='keyword',
+            name='idx_keyword_pending',
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='lease_expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+        # Keywords already pending when this runs get a lease from their request time, so lost ones are reaped normally
+        migrations.RunSQL(
+            sql="UPDATE ranker_keyword SET lease_expires_at = requested_at + interval '30 minutes' WHERE status = 'pending'",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['lease_expires_at'], name='idx_keyword_pending_lease'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0048_keyword_lease'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='''
+              DELETE FROM ranker_brandkeyword a
+              USING ranker_brandkeyword b
+              WHERE a.brand_id = b.brand_id AND a.keyword_id = b.keyword_id AND a.id > b.id
+            ''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='brandkeyword',
+            constraint=models.UniqueConstraint(fields=('brand', 'keyword'), name='unique_brand_keyword'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0049_brandkeyword_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keywordfile',
+            name='rows_processed',
+            field=models.IntegerField(default=0),
+        ),
+    ]
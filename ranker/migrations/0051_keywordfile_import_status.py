@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0050_keywordfile_rows_processed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keywordfile',
+            name='import_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='keywordfile',
+            name='import_status',
+            field=models.CharField(blank=True, choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], max_length=20, null=True),
+        ),
+    ]
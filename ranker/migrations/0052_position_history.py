@@ -0,0 +1,65 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0051_keywordfile_import_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KeywordIntentSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('intents', models.TextField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PositionUrl',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.TextField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SerpFeatureSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('features', models.TextField(unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PositionSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('retrieved_on', models.DateField()),
+                ('position', models.SmallIntegerField(null=True)),
+                ('previous_position', models.SmallIntegerField(null=True)),
+                ('search_volume', models.IntegerField(null=True)),
+                ('keyword_difficulty', models.SmallIntegerField(null=True)),
+                ('cpc', models.DecimalField(decimal_places=2, max_digits=9, null=True)),
+                ('traffic', models.IntegerField(null=True)),
+                ('traffic_percent', models.DecimalField(decimal_places=2, max_digits=7, null=True)),
+                ('traffic_cost', models.DecimalField(decimal_places=2, max_digits=14, null=True)),
+                ('competition', models.DecimalField(decimal_places=2, max_digits=4, null=True)),
+                ('results', models.BigIntegerField(null=True)),
+                ('type', models.CharField(max_length=40, null=True)),
+                ('domain', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ranker.domain')),
+                ('intents', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='ranker.keywordintentset')),
+                ('keyword', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ranker.keyword')),
+                ('serp_features', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='ranker.serpfeatureset')),
+                ('url', models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='ranker.positionurl')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['keyword', 'retrieved_on'], include=('search_volume',), name='idx_snapshot_keyword_day')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='positionsnapshot',
+            constraint=models.UniqueConstraint(fields=('domain', 'keyword', 'retrieved_on'), include=('position', 'search_volume', 'traffic'), name='unique_snapshot_domain_keyword_day'),
+        ),
+    ]
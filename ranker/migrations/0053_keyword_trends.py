@@ -0,0 +1,43 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:55
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import ranker.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0052_position_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='trend_peak_month',
+            field=models.SmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='trend_slope',
+            field=ranker.models.RealField(null=True),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='trends',
+            field=django.contrib.postgres.fields.ArrayField(base_field=ranker.models.RealField(), null=True, size=12),
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='trends_on',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(models.OrderBy(models.F('trend_slope'), descending=True), models.F('id'), condition=models.Q(('trend_slope__isnull', False)), name='idx_keyword_trend_slope'),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(('trend_peak_month__isnull', False)), fields=['trend_peak_month', '-search_volume'], name='idx_keyword_peak_month'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-18 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0053_keyword_trends'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sitemap',
+            name='max_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sitemap',
+            name='shard',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(condition=models.Q(('answered_at__isnull', False)), fields=['updated_at'], include=('id',), name='idx_keyword_answered_updated'),
+        ),
+        migrations.AddConstraint(
+            model_name='sitemap',
+            constraint=models.UniqueConstraint(fields=('category', 'shard'), name='unique_sitemap_shard'),
+        ),
+    ]
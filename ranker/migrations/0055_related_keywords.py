@@ -0,0 +1,48 @@
+# Generated by Django 4.2.1 on 2026-10-18 13:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0054_sitemap_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedKeyword',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='keyword',
+            name='related_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='keyword',
+            index=models.Index(models.OrderBy(models.F('related_at'), nulls_first=True), condition=models.Q(('answered_at__isnull', False)), name='idx_keyword_related_at'),
+        ),
+        migrations.AddField(
+            model_name='relatedkeyword',
+            name='keyword',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_links', to='ranker.keyword'),
+        ),
+        migrations.AddField(
+            model_name='relatedkeyword',
+            name='related',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ranker.keyword'),
+        ),
+        migrations.AddIndex(
+            model_name='relatedkeyword',
+            index=models.Index(fields=['keyword', '-score'], include=('related',), name='idx_related_keyword_score'),
+        ),
+        migrations.AddConstraint(
+            model_name='relatedkeyword',
+            constraint=models.UniqueConstraint(fields=('keyword', 'related'), name='unique_related_keyword'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0055_related_keywords'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keyword',
+            name='lease_token',
+            field=models.UUIDField(null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:40
+
+from django.db import migrations
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ranker", "0056_keyword_lease_token"),
+    ]
+
+    # The statement-level update trigger ran for every UPDATE of ranker_keyword (volumes, scores, leases, trends), and
+    # statement triggers with transition tables can't be limited to a column. A row-level trigger can skip rows whose
+    # status didn't change in its WHEN clause, so the function only runs for real state changes.
+    # Inserts and deletes always change the counts and keep their statement-level triggers.
+    operations = [
+        migrations.RunSQL(
+            sql='''
+              CREATE OR REPLACE FUNCTION ranker_keyword_status_change()
+              RETURNS trigger AS $$
+              BEGIN
+                INSERT INTO ranker_statisticdelta (key, amount, created_at)
+                VALUES ('keywords_' || OLD.status, -1, now()), ('keywords_' || NEW.status, 1, now());
+                RETURN NULL;
+              END;
+              $$ LANGUAGE plpgsql;
+
+              DROP TRIGGER IF EXISTS keyword_status_counts_update ON ranker_keyword;
+
+              CREATE TRIGGER keyword_status_counts_update
+              AFTER UPDATE OF status ON ranker_keyword
+              FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+              EXECUTE FUNCTION ranker_keyword_status_change();
+            ''',
+
+            reverse_sql = '''
+              DROP TRIGGER IF EXISTS keyword_status_counts_update ON ranker_keyword;
+
+              CREATE TRIGGER keyword_status_counts_update
+              AFTER UPDATE ON ranker_keyword
+              REFERENCING OLD TABLE AS old_keywords NEW TABLE AS new_keywords
+              FOR EACH STATEMENT EXECUTE FUNCTION ranker_keyword_status_counts();
+
+              DROP FUNCTION IF EXISTS ranker_keyword_status_change();
+            '''
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ranker', '0057_keyword_status_change_trigger'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keywordfile',
+            name='import_lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
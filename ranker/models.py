@@ -1,16 +1,25 @@
-from django.db import models, transaction
+from django.db import models, transaction, connection
+from django.conf import settings
 from django.utils import timezone
+from datetime import timedelta
+import uuid
 from django.utils.text import slugify
 from django.urls import reverse
-from django.db.models import UniqueConstraint, Max 
+from django.db.models import UniqueConstraint, Max, F, Q
 from django.core.validators import FileExtensionValidator, RegexValidator
 from django.contrib.postgres.search import SearchVectorField
 from django.contrib.postgres.indexes import GinIndex # add the Postgres recommended GIN index 
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 
 from accounts.models import User 
 # Create your models here.
 
+class RealField(models.FloatField):
+    # Single precision float (Postgres real), half the size of FloatField's double precision
+    def db_type(self, connection):
+        return 'real'
+
 def alphanumeric_validator():
     return RegexValidator(r'^[a-zA-Z0-9-_ ]+$',
         'Only numbers, letters, underscores, dashes and spaces are allowed.')
@@ -70,14 +79,78 @@ class Statistic(models.Model):
     key     = models.CharField(max_length=200, unique=True)
     value   = models.BigIntegerField(null=True, blank=True)
 
+class StatisticDelta(models.Model):
+    # Append-only log of changes to a Statistic. Writers insert here instead of locking the Statistic row,
+    # readers add the outstanding deltas to the stored value, and compact_statistics folds them in periodically.
+    key     = models.CharField(max_length=200, db_index=True)
+    amount  = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
 def add_value(key, amount):
-    #Select for update locks the rows of the stats table until the transaction has completed.
+    add_values({key: amount})
+
+def add_values(amounts):
+    # Record several counter changes with a single insert and no row locks
+    StatisticDelta.objects.bulk_create([StatisticDelta(key=key, amount=amount) for key, amount in amounts.items() if amount])
+
+def get_values(*keys):
+    # Stored value plus outstanding deltas, read in one statement so a concurrent compaction is seen either entirely or not at all
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT k.key, (COALESCE(s.value, 0) + COALESCE((SELECT SUM(d.amount) FROM ranker_statisticdelta d WHERE d.key = k.key), 0))::bigint
+            FROM unnest(%s::varchar[]) AS k(key)
+            LEFT JOIN ranker_statistic s ON s.key = k.key
+        """, [list(keys)])
+        return dict(cursor.fetchall())
+
+def get_value(key):
+    return get_values(key)[key]
+
+def set_value(key, value):
+    # Overwrite a statistic, discarding any deltas recorded before this point
     with transaction.atomic():
-        stat = Statistic.objects.select_for_update().get(key=key)
-        stat.value = stat.value + amount
-        stat.save()
+        StatisticDelta.objects.filter(key=key).delete()
+        Statistic.objects.update_or_create(key=key, defaults={'value': value})
+
+def fold_statistic_deltas():
+    # Move every outstanding delta into its Statistic row in a single statement. Returns the number of keys touched.
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH folded AS (
+                DELETE FROM ranker_statisticdelta RETURNING key, amount
+            )
+            INSERT INTO ranker_statistic (key, value)
+            SELECT key, SUM(amount) FROM folded GROUP BY key
+            ON CONFLICT (key) DO UPDATE SET value = COALESCE(ranker_statistic.value, 0) + EXCLUDED.value
+        """)
+        return cursor.rowcount
+
+class CompletionCache(models.Model):
+    # Content-addressed store of API completions, so identical prompts don't spend quota twice
+    key         = models.CharField(max_length=64, unique=True) # sha256 of model, temperature and normalized prompt
+    ai_model    = models.CharField(max_length=200)
+    temperature = models.FloatField()
+    prompt      = models.TextField()
+    response    = models.TextField()
+    hits        = models.IntegerField(default=0)
+    used_at     = models.DateTimeField(default=timezone.now) # Last stored or served, used for least recently used eviction
+    created_at  = models.DateTimeField(auto_now_add=True)
+    updated_at  = models.DateTimeField(auto_now=True)
+    def __str__(self):
+        return f"{self.ai_model}: {self.prompt[:50]}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['used_at']),
+        ]
 
 class Keyword(models.Model):
+    status_choices = [
+        ('available', 'available'),
+        ('pending', 'pending'),
+        ('answered', 'answered'),
+    ]
     keyword                     = models.CharField(max_length=200, unique=True)
     user_intent                 = models.TextField(null=True)
     natural_language_question   = models.TextField(null=True)
@@ -92,6 +165,15 @@ class Keyword(models.Model):
     search_volume               = models.IntegerField(null=True)
     num_brands                  = models.IntegerField(null=True)
     priority                    = models.IntegerField(null=True)
+    status                      = models.CharField(max_length=20, choices=status_choices, default='available')
+    lease_expires_at            = models.DateTimeField(null=True)
+    lease_token                 = models.UUIDField(null=True) # Identifies the claim holding the lease
+    # Semrush's 12 month search trend, oldest month first, with its least squares slope and the calendar month it peaks in
+    trends                      = ArrayField(RealField(), size=12, null=True)
+    trend_slope                 = RealField(null=True)
+    trend_peak_month            = models.SmallIntegerField(null=True)
+    trends_on                   = models.DateField(null=True)
+    related_at                  = models.DateTimeField(null=True)
     
     def __str__(self):
         return self.keyword
@@ -104,10 +186,154 @@ class Keyword(models.Model):
     class Meta:
         indexes = [
             GinIndex(fields=["search_vector"]),
-            models.Index(name="idx_answered_requested_at", fields=['answered_at'], include=['requested_at'])
+            models.Index(name="idx_answered_requested_at", fields=['answered_at'], include=['requested_at']),
+            # One partial index per queue state. The available index is in claim order, so picking the next batch is a short index scan.
+            models.Index(F('priority').desc(nulls_last=True), F('search_volume').desc(nulls_last=True), F('id'), name="idx_keyword_available_queue", condition=Q(status='available')),
+            models.Index(name="idx_keyword_pending_lease", fields=['lease_expires_at'], condition=Q(status='pending')),
+            models.Index(name="idx_keyword_answered", fields=['answered_at'], condition=Q(status='answered')),
+            # Rising keywords and seasonal keywords by peak month, without touching keywords that have no trend
+            models.Index(F('trend_slope').desc(), F('id'), name="idx_keyword_trend_slope", condition=Q(trend_slope__isnull=False)),
+            # Answered keywords changed since the last sitemap refresh
+            models.Index(name="idx_keyword_answered_updated", fields=['updated_at'], include=['id'], condition=Q(answered_at__isnull=False)),
+            # Answered keywords whose related links were never computed first, then the oldest
+            models.Index(F('related_at').asc(nulls_first=True), name="idx_keyword_related_at", condition=Q(answered_at__isnull=False)),
+            models.Index(name="idx_keyword_peak_month", fields=['trend_peak_month', '-search_volume'], condition=Q(trend_peak_month__isnull=False)),
         ]
         permissions = (("manage_keywords", "Can run all keyword functions"),)
 
+def upsert_keywords(keyword_texts):
+    # Inserts the keywords that don't exist yet and returns ({keyword: id} for all of them, number inserted).
+    # The outer SELECT reads the snapshot from before the insert, so existing and new rows are each returned exactly once.
+    # A keyword committed by a concurrent import after that snapshot is in neither branch; it is visible to the next
+    # statement, so the keywords still missing are upserted again until every one has an id.
+    keyword_ids = {}
+    inserted = 0
+    pending = list(keyword_texts)
+    with connection.cursor() as cursor:
+        while pending:
+            cursor.execute("""
+                WITH inserted AS (
+                    INSERT INTO ranker_keyword (keyword, status, created_at, updated_at)
+                    SELECT keyword, 'available', now(), now() FROM unnest(%(keywords)s::varchar[]) AS keyword
+                    ON CONFLICT (keyword) DO NOTHING
+                    RETURNING keyword, id
+                )
+                SELECT keyword, id, true FROM inserted
+                UNION ALL
+                SELECT keyword, id, false FROM ranker_keyword WHERE keyword = ANY(%(keywords)s::varchar[])
+            """, {'keywords': pending})
+            for keyword, keyword_id, was_inserted in cursor.fetchall():
+                keyword_ids[keyword] = keyword_id
+                inserted += was_inserted
+            pending = [keyword for keyword in pending if keyword not in keyword_ids]
+    return keyword_ids, inserted
+
+def update_keyword_trends(trends):
+    # trends is {keyword_id: (trends_on, values, slope, peak_month)}. Writes them in one statement, skipping keywords that
+    # already have a trend from a later file or the same one, so files imported out of order don't roll trends back.
+    keyword_ids = sorted(trends)
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE ranker_keyword k
+            SET trends = string_to_array(t.trends, ',')::real[], trend_slope = t.trend_slope, trend_peak_month = t.trend_peak_month, trends_on = t.trends_on
+            FROM unnest(%s::integer[], %s::date[], %s::text[], %s::real[], %s::smallint[]) AS t(id, trends_on, trends, trend_slope, trend_peak_month)
+            WHERE k.id = t.id AND (k.trends_on IS NULL OR k.trends_on <= t.trends_on)
+              AND (k.trends, k.trends_on) IS DISTINCT FROM (string_to_array(t.trends, ',')::real[], t.trends_on)
+        """, [
+            keyword_ids,
+            [trends[keyword_id][0] for keyword_id in keyword_ids],
+            [','.join(str(value) for value in trends[keyword_id][1]) for keyword_id in keyword_ids],
+            [trends[keyword_id][2] for keyword_id in keyword_ids],
+            [trends[keyword_id][3] for keyword_id in keyword_ids],
+        ])
+        return cursor.rowcount
+
+def claim_keywords(batch_size):
+    # Move up to batch_size of the highest priority available keywords to pending and return (lease token, their ids).
+    # SKIP LOCKED lets several refills run at once without waiting on, or double-dispatching, each other's rows.
+    # Each claimed keyword gets a lease; if nothing renews or answers it before the lease expires, the reaper frees it.
+    # Renewing or answering needs the claim's token, so a batch whose keywords were reaped and claimed again can't touch them.
+    lease_token = uuid.uuid4()
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE ranker_keyword SET status = 'pending', requested_at = now(), lease_expires_at = now() + make_interval(secs => %s), lease_token = %s::uuid
+            WHERE id IN (
+                SELECT id FROM ranker_keyword
+                WHERE status = 'available'
+                ORDER BY priority DESC NULLS LAST, search_volume DESC NULLS LAST, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        """, [settings.KEYWORD_LEASE_SECONDS, str(lease_token), batch_size])
+        return lease_token, [row[0] for row in cursor.fetchall()]
+
+def rescore_keywords(start_id, end_id):
+    # Recompute priority for available keywords with ids in [start_id, end_id). The score grows with the log of search volume,
+    # is boosted by how many brands rank for the keyword, and gains points with age so low or unknown volume keywords still
+    # get their turn. Age is counted in whole days, so a keyword's score changes at most once a day and only rows whose
+    # priority actually changes are written. Returns the number of keywords rescored.
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE ranker_keyword k SET priority = s.priority
+            FROM (
+                SELECT id, round(
+                    1000 * ln(1 + COALESCE(search_volume, 0)) * (1 + %(brand_weight)s * ln(1 + COALESCE(num_brands, 0)))
+                    + %(age_points)s * LEAST(current_date - created_at::date, %(age_days)s)::numeric / %(age_days)s
+                )::integer AS priority
+                FROM ranker_keyword
+                WHERE id >= %(start_id)s AND id < %(end_id)s AND status = 'available'
+            ) s
+            WHERE k.id = s.id AND k.priority IS DISTINCT FROM s.priority
+        """, {
+            'brand_weight': settings.KEYWORD_PRIORITY_BRAND_WEIGHT,
+            'age_points': settings.KEYWORD_PRIORITY_AGE_POINTS,
+            'age_days': settings.KEYWORD_PRIORITY_AGE_DAYS,
+            'start_id': start_id,
+            'end_id': end_id,
+        })
+        return cursor.rowcount
+
+def refresh_keyword_volumes(start_id=None, end_id=None, keyword_ids=None):
+    # Recomputes search_volume (average over position snapshots) and num_brands for the keywords in [start_id, end_id),
+    # or in keyword_ids, with one UPDATE ... FROM a grouped aggregate. Keywords whose values didn't change aren't rewritten.
+    # Keywords with no position snapshots keep their search_volume: those with only legacy KeywordPosition rows
+    # haven't been through backfillpositions yet. Returns the number of keywords updated.
+    if keyword_ids is not None:
+        condition = "{column} = ANY(%(keyword_ids)s)"
+    else:
+        condition = "{column} >= %(start_id)s AND {column} < %(end_id)s"
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE ranker_keyword k SET search_volume = agg.search_volume, num_brands = agg.num_brands
+            FROM (
+                SELECT t.id, COALESCE(volumes.search_volume, t.search_volume) AS search_volume, COALESCE(brands.num_brands, 0) AS num_brands
+                FROM ranker_keyword t
+                LEFT JOIN (
+                    SELECT keyword_id, round(avg(search_volume))::integer AS search_volume
+                    FROM ranker_positionsnapshot WHERE {condition.format(column='keyword_id')}
+                    GROUP BY keyword_id
+                ) volumes ON volumes.keyword_id = t.id
+                LEFT JOIN (
+                    SELECT keyword_id, count(*)::integer AS num_brands
+                    FROM ranker_brandkeyword WHERE {condition.format(column='keyword_id')}
+                    GROUP BY keyword_id
+                ) brands ON brands.keyword_id = t.id
+                WHERE {condition.format(column='t.id')}
+            ) agg
+            WHERE k.id = agg.id AND (k.search_volume, k.num_brands) IS DISTINCT FROM (agg.search_volume, agg.num_brands)
+        """, {'start_id': start_id, 'end_id': end_id, 'keyword_ids': list(keyword_ids or [])})
+        return cursor.rowcount
+
+def renew_keyword_leases(keyword_ids, lease_token):
+    # Heartbeat from the worker holding these keywords. Keywords the reaper already freed, or another claim now holds, are left alone.
+    lease_expires_at = timezone.now() + timedelta(seconds=settings.KEYWORD_LEASE_SECONDS)
+    return Keyword.objects.filter(id__in=keyword_ids, status='pending', lease_token=lease_token).update(lease_expires_at=lease_expires_at)
+
+def release_expired_keyword_leases():
+    # Return keywords whose lease ran out to the available pool, in one statement
+    return Keyword.objects.filter(status='pending', lease_expires_at__lt=timezone.now()).update(status='available', requested_at=None, lease_expires_at=None, lease_token=None)
+
 class Answer(models.Model):
     answer                      = models.TextField(null=True)
     keyword                     = models.ForeignKey(Keyword, on_delete=models.CASCADE)
@@ -156,6 +382,80 @@ class KeywordPosition(models.Model):
     def __str__(self):
         return f"{self.keyword} - {self.domain} - {self.position}"
 
+# Rank history. Repeated text (urls, SERP features, intents) lives once in a lookup table, and each snapshot is one
+# narrow numeric row per domain, keyword and retrieval day.
+class PositionUrl(models.Model):
+    url = models.TextField(unique=True)
+    def __str__(self):
+        return self.url
+
+class SerpFeatureSet(models.Model):
+    features = models.TextField(unique=True) # Sorted, comma separated, see normalize_feature_set
+    def __str__(self):
+        return self.features
+
+class KeywordIntentSet(models.Model):
+    intents = models.TextField(unique=True) # Sorted, comma separated, see normalize_feature_set
+    def __str__(self):
+        return self.intents
+
+def normalize_feature_set(value):
+    # Same set in any order maps to one lookup row. Sorted by code point, which matches COLLATE "C" in SQL.
+    features = sorted(set(part.strip() for part in (value or '').split(',') if part.strip()))
+    return ','.join(features) or None
+
+class PositionSnapshot(models.Model):
+    domain              = models.ForeignKey(Domain, on_delete=models.CASCADE)
+    keyword             = models.ForeignKey(Keyword, on_delete=models.CASCADE)
+    retrieved_on        = models.DateField()
+    position            = models.SmallIntegerField(null=True)
+    previous_position   = models.SmallIntegerField(null=True)
+    search_volume       = models.IntegerField(null=True)
+    keyword_difficulty  = models.SmallIntegerField(null=True)
+    cpc                 = models.DecimalField(max_digits=9, decimal_places=2, null=True)
+    traffic             = models.IntegerField(null=True)
+    traffic_percent     = models.DecimalField(max_digits=7, decimal_places=2, null=True)
+    traffic_cost        = models.DecimalField(max_digits=14, decimal_places=2, null=True)
+    competition         = models.DecimalField(max_digits=4, decimal_places=2, null=True)
+    results             = models.BigIntegerField(null=True)
+    url                 = models.ForeignKey(PositionUrl, on_delete=models.PROTECT, null=True)
+    serp_features       = models.ForeignKey(SerpFeatureSet, on_delete=models.PROTECT, null=True)
+    intents             = models.ForeignKey(KeywordIntentSet, on_delete=models.PROTECT, null=True)
+    type                = models.CharField(max_length=40, null=True)
+    def __str__(self):
+        return f"{self.keyword_id} - {self.domain_id} - {self.retrieved_on} - {self.position}"
+    class Meta:
+        constraints = [
+            # Position over time for a domain (and keyword) is an index only scan
+            UniqueConstraint(name='unique_snapshot_domain_keyword_day', fields=['domain', 'keyword', 'retrieved_on'], include=['position', 'search_volume', 'traffic']),
+        ]
+        indexes = [
+            models.Index(name="idx_snapshot_keyword_day", fields=['keyword', 'retrieved_on'], include=['search_volume']),
+        ]
+
+def upsert_lookup(model, field, values):
+    # Returns {value: id} for every value, inserting the ones the lookup table doesn't have yet. As in upsert_keywords,
+    # values committed concurrently after the statement's snapshot are resolved by upserting the missing ones again.
+    table = model._meta.db_table
+    value_ids = {}
+    pending = sorted(set(values))
+    with connection.cursor() as cursor:
+        while pending:
+            cursor.execute(f"""
+                WITH inserted AS (
+                    INSERT INTO {table} ({field})
+                    SELECT value FROM unnest(%(values)s::text[]) AS value
+                    ON CONFLICT ({field}) DO NOTHING
+                    RETURNING {field}, id
+                )
+                SELECT {field}, id FROM inserted
+                UNION ALL
+                SELECT {field}, id FROM {table} WHERE {field} = ANY(%(values)s::text[])
+            """, {'values': pending})
+            value_ids.update(cursor.fetchall())
+            pending = [value for value in pending if value not in value_ids]
+    return value_ids
+
 class Brand(models.Model):
     brand = models.CharField(max_length=200, db_index=True, unique=True)
     domain = models.ManyToManyField(
@@ -200,6 +500,122 @@ class BrandKeyword(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     def __str__(self):
         return f"{self.brand}: {self.keyword}"
+    class Meta:
+        constraints = [
+            UniqueConstraint(name='unique_brand_keyword', fields=['brand', 'keyword']),
+        ]
+
+# Brands are matched with the same text search configuration the keyword search_vector trigger uses
+def count_brand_matches(brand_ids, limit):
+    # Returns {brand_id: matching keywords}. Counting stops at limit + 1, so generic brands are cheap to detect.
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT b.id, (
+                SELECT COUNT(*) FROM (
+                    SELECT 1 FROM ranker_keyword k
+                    WHERE k.search_vector @@ websearch_to_tsquery('pg_catalog.english', b.brand)
+                    LIMIT %s
+                ) matches
+            )
+            FROM ranker_brand b WHERE b.id = ANY(%s)
+        """, [limit + 1, list(brand_ids)])
+        return dict(cursor.fetchall())
+
+def link_brand_keywords(brand_ids):
+    # Writes a BrandKeyword row for every keyword matching each brand in one INSERT ... SELECT, so keywords never
+    # leave the database. Existing links are skipped. Returns the number of links created.
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO ranker_brandkeyword (brand_id, keyword_id, created_at, updated_at)
+            SELECT b.id, k.id, now(), now()
+            FROM ranker_brand b
+            JOIN ranker_keyword k ON k.search_vector @@ websearch_to_tsquery('pg_catalog.english', b.brand)
+            WHERE b.id = ANY(%s)
+            ON CONFLICT (brand_id, keyword_id) DO NOTHING
+        """, [list(brand_ids)])
+        return cursor.rowcount
+
+def link_keyword_brands(keyword_ids):
+    # The incremental side of link_brand_keywords: matches only the given keywords against every brand whose indexing has
+    # started, with the same search_vector predicate. Brands still waiting for their first full scan are left to that scan.
+    # Returns the number of links created.
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            WITH brands AS MATERIALIZED (
+                SELECT id, websearch_to_tsquery('pg_catalog.english', brand) AS query
+                FROM ranker_brand WHERE indexing_requested_at IS NOT NULL
+            )
+            INSERT INTO ranker_brandkeyword (brand_id, keyword_id, created_at, updated_at)
+            SELECT b.id, k.id, now(), now()
+            FROM ranker_keyword k
+            JOIN brands b ON k.search_vector @@ b.query
+            WHERE k.id = ANY(%s)
+            ON CONFLICT (brand_id, keyword_id) DO NOTHING
+        """, [list(keyword_ids)])
+        return cursor.rowcount
+
+class RelatedKeyword(models.Model):
+    # Precomputed "related keywords" links shown on a keyword's page, best score first. Written by relate_keywords, from
+    # ranker.tasks.refresh_related_keywords after a keyword is answered, so the page reads them with one index scan.
+    keyword = models.ForeignKey(Keyword, on_delete=models.CASCADE, related_name='related_links')
+    related = models.ForeignKey(Keyword, on_delete=models.CASCADE, related_name='+')
+    score   = models.FloatField()
+    def __str__(self):
+        return f"{self.keyword_id} -> {self.related_id} ({self.score})"
+    class Meta:
+        constraints = [
+            UniqueConstraint(name='unique_related_keyword', fields=['keyword', 'related']),
+        ]
+        indexes = [
+            models.Index(name="idx_related_keyword_score", fields=['keyword', '-score'], include=['related']),
+        ]
+
+def related_queries(likely_previous_queries, likely_next_queries):
+    # The follow up queries stored with an answer, as a list. The model sometimes answers with a single string or 'none'.
+    queries = []
+    for value in (likely_previous_queries, likely_next_queries):
+        if type(value) is str and value != 'none':
+            queries.append(value)
+        if type(value) is list:
+            queries.extend(str(query) for query in value)
+    return queries
+
+def relate_keywords(queries, per_query, limit):
+    # queries is {keyword_id: [query, ...]}. Replaces each keyword's related links with the best per_query full text
+    # matches of each of its queries, up to limit links per keyword, scored by their best ts_rank.
+    # One statement for the whole batch; returns the number of links written. A page view can relate a keyword while the
+    # refresh task does too, so links the other one wrote first are updated instead of failing on the unique constraint.
+    pairs = [(keyword_id, query) for keyword_id in sorted(queries) for query in queries[keyword_id]]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM ranker_relatedkeyword WHERE keyword_id = ANY(%s)", [sorted(queries)])
+        cursor.execute("""
+            INSERT INTO ranker_relatedkeyword (keyword_id, related_id, score)
+            SELECT keyword_id, related_id, score FROM (
+                SELECT keyword_id, related_id, score, row_number() OVER (PARTITION BY keyword_id ORDER BY score DESC, related_id) AS n
+                FROM (
+                    SELECT q.keyword_id, m.id AS related_id, max(m.rank) AS score
+                    FROM unnest(%(keyword_ids)s::bigint[], %(queries)s::text[]) AS q(keyword_id, query)
+                    CROSS JOIN LATERAL (
+                        SELECT k.id, ts_rank(k.search_vector, websearch_to_tsquery('pg_catalog.english', q.query)) AS rank
+                        FROM ranker_keyword k
+                        WHERE k.search_vector @@ websearch_to_tsquery('pg_catalog.english', q.query) AND k.id <> q.keyword_id
+                        ORDER BY rank DESC, k.id
+                        LIMIT %(per_query)s
+                    ) m
+                    GROUP BY q.keyword_id, m.id
+                ) matches
+            ) ranked
+            WHERE n <= %(limit)s
+            ON CONFLICT (keyword_id, related_id) DO UPDATE SET score = EXCLUDED.score
+        """, {
+            'keyword_ids': [keyword_id for keyword_id, query in pairs],
+            'queries': [query for keyword_id, query in pairs],
+            'per_query': per_query,
+            'limit': limit,
+        })
+        written = cursor.rowcount
+        Keyword.objects.filter(id__in=list(queries)).update(related_at=timezone.now())
+    return written
 
 class Competition(models.Model):
     domain = models.ForeignKey(Domain, on_delete=models.CASCADE, related_name='source_domain_set')
@@ -219,17 +635,50 @@ def keyword_directory_path(instance, filename=None):
     return f"documents/{d.id}-{d.domain}/{filename}"
 
 class KeywordFile(models.Model):
+    import_status_choices = [
+        ('queued', 'queued'),
+        ('running', 'running'),
+        ('done', 'done'),
+        ('failed', 'failed'),
+    ]
     domain      = models.ForeignKey(Domain, on_delete=models.CASCADE)
     filepath    = models.FileField(upload_to=keyword_directory_path, validators=[FileExtensionValidator(allowed_extensions=["csv"])])
     uploaded_at = models.DateTimeField(auto_now_add=True)
     primary     = models.BooleanField(default=False)
     processed_at = models.DateTimeField(default=None, null=True)
+    rows_processed = models.IntegerField(default=0) # Import checkpoint: rows already committed from this file
+    import_status = models.CharField(max_length=20, choices=import_status_choices, null=True, blank=True)
+    import_error = models.TextField(null=True, blank=True)
+    import_lease_expires_at = models.DateTimeField(null=True, blank=True) # Renewed by a running import after every chunk
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     def __str__(self):
         return self.filepath.name
     def get_absolute_url(self):
         return reverse('domain_detail', args=[str(self.domain.id)])
+
+def keyword_import_lease():
+    return timezone.now() + timedelta(seconds=settings.KEYWORD_IMPORT_LEASE_SECONDS)
+
+def queue_keyword_file(keywordfile_id):
+    # Moves an unprocessed file that was never imported, or whose import failed, to queued. Returns whether it did, so
+    # only the request that queued the file sends its task.
+    return KeywordFile.objects.filter(
+        Q(import_status__isnull=True) | Q(import_status='failed'), id=keywordfile_id, processed_at=None,
+    ).update(import_status='queued', import_error=None) == 1
+
+def start_keyword_file_import(keywordfile_id):
+    # Claims a queued file for the task about to import it. Returns False when another task already claimed it.
+    return KeywordFile.objects.filter(id=keywordfile_id, import_status='queued').update(
+        import_status='running', import_error=None, import_lease_expires_at=keyword_import_lease(),
+    ) == 1
+
+def release_expired_import_leases():
+    # Marks imports whose worker stopped renewing the lease as failed, so the file can be queued again. The import
+    # resumes from its rows_processed checkpoint.
+    return KeywordFile.objects.filter(import_status='running', import_lease_expires_at__lt=timezone.now()).update(
+        import_status='failed', import_error='Import stopped: its worker went away', import_lease_expires_at=None,
+    )
     
 class TokenType(models.Model):
     type = models.CharField(max_length=200, unique=True)
@@ -372,4 +821,12 @@ class Sitemap(models.Model):
       )
     url = models.CharField(max_length=250)
     lastmod = models.DateTimeField(auto_now=True)
-    category = models.CharField(choices=SITEMAP_CATEGORIES, max_length=50, null=True, blank=True, default='static')
\ No newline at end of file
+    category = models.CharField(choices=SITEMAP_CATEGORIES, max_length=50, null=True, blank=True, default='static')
+    # Keyword sitemaps are sharded by fixed keyword id ranges. max_updated_at is the newest keyword in the shard when
+    # its file was last written; the shard is rewritten only when a keyword in its range is newer than that.
+    shard = models.IntegerField(null=True, blank=True)
+    max_updated_at = models.DateTimeField(null=True, blank=True)
+    class Meta:
+        constraints = [
+            UniqueConstraint(name='unique_sitemap_shard', fields=['category', 'shard']),
+        ]
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+import hashlib
+
+# Rendered keyword pages, served to anonymous visitors without touching Postgres. Entries are keyed by keyword id and
+# layout version, and deleted whenever the keyword's answer changes; the timeout only bounds how stale the related
+# keywords and model list on a page can get.
+
+def keyword_page_key(keyword_id):
+    return f"keyword_page:v{settings.KEYWORD_PAGE_CACHE_VERSION}:{keyword_id}"
+
+def get_keyword_page(keyword_id):
+    return cache.get(keyword_page_key(keyword_id))
+
+def store_keyword_page(keyword_id, path, content):
+    # Keeps the canonical path with the page, so non-canonical urls can be redirected from the cache as well
+    page = {
+        'path': path,
+        'content': content,
+        'etag': f'"{hashlib.md5(content).hexdigest()}"',
+        'last_modified': timezone.now().timestamp(),
+    }
+    cache.set(keyword_page_key(keyword_id), page, settings.KEYWORD_PAGE_CACHE_SECONDS)
+    return page
+
+def invalidate_keyword_pages(keyword_ids):
+    cache.delete_many([keyword_page_key(keyword_id) for keyword_id in keyword_ids])
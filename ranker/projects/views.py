@@ -132,5 +132,5 @@ def project_get_all_responses(request, project_id):
             for message in conversation.message_set.all():
                 message.requested_at = timezone.now()
                 message.save()
-                call_openai.apply_async( (message.prompt,), link=save_message_response.s(message.id)) #note the comma in arguments, critical to imply tuple, otherwise thinks array
+                call_openai.apply_async( (message.prompt,), {'expect_json': message.template_item.mode == 'json'}, link=save_message_response.s(message.id)) #note the comma in arguments, critical to imply tuple, otherwise thinks array
     return redirect('conversation_detail', conversation_id=conversation.id)
\ No newline at end of file
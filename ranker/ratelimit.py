@@ -0,0 +1,95 @@
+from django.conf import settings
+
+import asyncio, hashlib, time
+
+from ranker.connections import app_redis
+
+# Token bucket shared by every worker through Redis. One hash per (model, API key) holds two buckets:
+# requests and tokens. Both refill continuously at their per-minute rate and are capped at
+# OPENAI_RATE_LIMIT_BURST_SECONDS worth of capacity, so a cold start can't dump a full minute of
+# traffic on the API at once. The script returns 0 when the request was granted, otherwise the
+# number of milliseconds to wait before trying again.
+TAKE_SCRIPT = app_redis.register_script("""
+local key       = KEYS[1]
+local rpm       = tonumber(ARGV[1])
+local tpm       = tonumber(ARGV[2])
+local burst     = tonumber(ARGV[3])
+local cost      = tonumber(ARGV[4])
+
+local time      = redis.call('TIME')
+local now       = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local request_capacity  = math.max(rpm * burst / 60, 1)
+local token_capacity    = math.max(tpm * burst / 60, 1)
+cost = math.min(cost, token_capacity)
+
+local state     = redis.call('HMGET', key, 'requests', 'tokens', 'updated_at')
+local requests  = tonumber(state[1]) or request_capacity
+local tokens    = tonumber(state[2]) or token_capacity
+local updated_at = tonumber(state[3]) or now
+
+local elapsed   = math.max(now - updated_at, 0)
+requests    = math.min(request_capacity, requests + elapsed * rpm / 60)
+tokens      = math.min(token_capacity, tokens + elapsed * tpm / 60)
+
+local wait = 0
+if requests >= 1 and tokens >= cost then
+    requests    = requests - 1
+    tokens      = tokens - cost
+else
+    wait = math.max((1 - requests) * 60 / rpm, (cost - tokens) * 60 / tpm, 0)
+end
+
+redis.call('HSET', key, 'requests', tostring(requests), 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', key, 3600)
+return math.ceil(wait * 1000)
+""")
+
+
+class TokenBucket:
+    def __init__(self, ai_model, api_key, requests_per_minute, tokens_per_minute, burst_seconds):
+        api_key_hash = hashlib.sha256((api_key or '').encode()).hexdigest()[:16] # Never store the key itself in Redis
+        self.key = f"openai_ratelimit:{ai_model}:{api_key_hash}"
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+
+    def try_acquire(self, tokens):
+        # Returns 0 if one request and `tokens` tokens were taken, otherwise the seconds to wait before retrying.
+        wait_ms = TAKE_SCRIPT(keys=[self.key], args=[self.requests_per_minute, self.tokens_per_minute, self.burst_seconds, tokens])
+        return wait_ms / 1000
+
+    def acquire(self, tokens):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        # The Redis client is synchronous, so each poll runs in a thread instead of blocking the event loop
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def adjust(self, tokens):
+        # Settle the difference between the estimate taken up front and the usage the API actually reported.
+        # A positive amount takes more tokens from the bucket, a negative one gives them back.
+        if tokens:
+            app_redis.hincrbyfloat(self.key, 'tokens', -tokens)
+
+
+def estimate_tokens(prompt):
+    # Roughly four characters per token for English text, plus room for the completion.
+    return len(prompt) // 4 + settings.OPENAI_EXPECTED_COMPLETION_TOKENS
+
+def openai_rate_limiter(ai_model, api_key):
+    return TokenBucket(
+        ai_model,
+        api_key,
+        requests_per_minute = settings.OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute   = settings.OPENAI_TOKENS_PER_MINUTE,
+        burst_seconds       = settings.OPENAI_RATE_LIMIT_BURST_SECONDS,
+    )
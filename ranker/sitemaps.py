@@ -0,0 +1,126 @@
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db.models import Max
+from django.utils import timezone
+
+from ranker.models import Keyword, Sitemap
+
+from datetime import timedelta
+import gzip, hashlib
+
+SITE_URL = "https://topranks.ai"
+
+# Keyword ids per sitemap shard. A shard holds at most this many urls, which keeps it within the protocol's 50,000 limit.
+# Changing it renumbers every shard, so run a full build_keyword_sitemaps afterwards.
+SHARD_SIZE = 50000
+
+# How far behind the newest watermark an incremental refresh starts looking, so keywords whose transaction committed
+# after a previous refresh read past their updated_at are still picked up
+REFRESH_OVERLAP = timedelta(hours=1)
+
+# Cached sitemap index responses. They are deleted whenever Sitemap rows change, the timeout is only a backstop.
+SITEMAP_CACHE_KEYS = ['sitemap:lastmod', 'sitemap:index', 'sitemap:static']
+SITEMAP_CACHE_SECONDS = 60 * 60 * 24
+
+def sitemap_lastmod():
+    # Newest Sitemap.lastmod, the Last-Modified of both index responses. Cached, so a conditional GET never reaches Postgres.
+    lastmod = cache.get('sitemap:lastmod')
+    if lastmod is None:
+        lastmod = Sitemap.objects.aggregate(lastmod=Max('lastmod'))['lastmod'] or timezone.now()
+        cache.set('sitemap:lastmod', lastmod, SITEMAP_CACHE_SECONDS)
+    return lastmod
+
+def sitemap_etag(name):
+    return hashlib.md5(f"{name}:{sitemap_lastmod().isoformat()}".encode()).hexdigest()
+
+def cached_sitemap(key, render):
+    content = cache.get(key)
+    if content is None:
+        content = render()
+        cache.set(key, content, SITEMAP_CACHE_SECONDS)
+    return content
+
+def invalidate_sitemap_cache():
+    cache.delete_many(SITEMAP_CACHE_KEYS)
+
+def answered_keywords(start_id, end_id, batch_size=10000):
+    # Yields one list of (id, keyword, updated_at) per batch for the answered keywords in [start_id, end_id), in id order.
+    # Keyset pagination: each batch starts after the last id of the previous one, so every batch is a short primary
+    # key range scan and no row is skipped or repeated.
+    last_id = start_id - 1
+    while True:
+        batch = list(
+            Keyword.objects.filter(answered_at__isnull=False, id__gt=last_id, id__lt=end_id).order_by('id')
+            .values_list('id', 'keyword', 'updated_at')[:batch_size]
+        )
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1][0]
+
+def write_sitemap(name, batches):
+    # Streams a gzipped urlset for batches of (id, keyword, updated_at) rows to storage and returns the public url of the file
+    with default_storage.open(name, 'wb') as the_file, gzip.GzipFile(fileobj=the_file, mode='wb') as gzipped:
+        gzipped.write(b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+        gzipped.write(b"<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\" xmlns:xhtml=\"http://www.w3.org/1999/xhtml\">\n")
+        for keywords in batches:
+            for keyword_id, keyword, updated_at in keywords:
+                url = Keyword(id=keyword_id, keyword=keyword).get_absolute_url()
+                gzipped.write(f"<url>\n\t<loc>{SITE_URL}{url}</loc>\n\t<lastmod>{updated_at.strftime('%Y-%m-%d')}</lastmod>\n</url>\n".encode())
+        gzipped.write(b"</urlset>")
+    return f"{SITE_URL}/media/{name}"
+
+def shard_watermarks(since=None):
+    # {shard: newest updated_at} over answered keywords, counting only keywords updated after since when it is given
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            SELECT id / %(shard_size)s, max(updated_at) FROM ranker_keyword
+            WHERE answered_at IS NOT NULL {'AND updated_at > %(since)s' if since else ''}
+            GROUP BY 1
+        """, {'shard_size': SHARD_SIZE, 'since': since})
+        return dict(cursor.fetchall())
+
+def write_keyword_shard(shard, max_updated_at):
+    # Each shard has a stable file name, so its index row only changes after the new file is fully written.
+    # The index is never empty or pointing at a half written file.
+    start_id = shard * SHARD_SIZE
+    url = write_sitemap(f"sitemaps/keywords/sitemap-keywords-{1000+shard}.xml.gz", answered_keywords(start_id, start_id + SHARD_SIZE))
+    Sitemap.objects.update_or_create(category='keywords', shard=shard, defaults={'url': url, 'max_updated_at': max_updated_at})
+    print(f"Sitemap (keywords): {url}")
+
+def build_keyword_sitemaps():
+    # Rewrites every shard, then drops index rows for shards that no longer have answered keywords.
+    # Returns the number of sitemap files written.
+    start_time = timezone.now()
+    watermarks = shard_watermarks()
+    for shard, max_updated_at in sorted(watermarks.items()):
+        write_keyword_shard(shard, max_updated_at)
+    Sitemap.objects.filter(category='keywords').exclude(shard__in=list(watermarks)).delete()
+    invalidate_sitemap_cache()
+
+    end_time = timezone.now()
+    print(f"Built {len(watermarks)} keyword sitemaps in {(end_time-start_time).total_seconds()} seconds.")
+    return len(watermarks)
+
+def refresh_keyword_sitemaps():
+    # Rewrites only the shards holding a keyword answered or updated since the shard was last written. Finding them reads
+    # the answered-and-updated index from just before the newest watermark. Returns the number of sitemap files written.
+    latest = Sitemap.objects.filter(category='keywords', shard__isnull=False).aggregate(latest=Max('max_updated_at'))['latest']
+    if latest is None:
+        return build_keyword_sitemaps()
+
+    start_time = timezone.now()
+    stored = dict(Sitemap.objects.filter(category='keywords', shard__isnull=False).values_list('shard', 'max_updated_at'))
+    changed = {
+        shard: max_updated_at for shard, max_updated_at in shard_watermarks(since=latest - REFRESH_OVERLAP).items()
+        if shard not in stored or stored[shard] is None or max_updated_at > stored[shard]
+    }
+    for shard, max_updated_at in sorted(changed.items()):
+        write_keyword_shard(shard, max_updated_at)
+    if changed:
+        invalidate_sitemap_cache()
+
+    end_time = timezone.now()
+    print(f"Refreshed {len(changed)} of {len(stored)} keyword sitemaps in {(end_time-start_time).total_seconds()} seconds.")
+    return len(changed)
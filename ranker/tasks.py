@@ -1,26 +1,83 @@
 from django.core.management import call_command
 from django.utils import timezone, html
 from django.conf import settings
-from django.core.files.storage import default_storage
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.db import transaction
+from django.contrib.postgres.search import SearchVector, SearchRank
 
 import os, openai, markdown, json, re, tldextract, requests
+import asyncio, aiohttp
 from celery import shared_task
 from celery.utils.log import get_task_logger
-
-from ranker.models import Message, Keyword, Domain, Brand, BrandKeyword, Statistic, add_value, Sitemap, AIModel, Answer
-from django.db.models import Count, Avg 
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from asgiref.sync import sync_to_async
+
+from ranker.models import Message, Keyword, KeywordFile, Domain, Brand, BrandKeyword, PositionSnapshot, Statistic, get_value, get_values, set_value, fold_statistic_deltas, claim_keywords, count_brand_matches, link_brand_keywords, link_keyword_brands, related_queries, relate_keywords, rescore_keywords, refresh_keyword_volumes, renew_keyword_leases, release_expired_keyword_leases, start_keyword_file_import, release_expired_import_leases, AIModel, Answer
+from ranker.ratelimit import openai_rate_limiter, estimate_tokens
+from ranker.concurrency import openai_concurrency
+from ranker.importing import import_keyword_file
+from ranker.sitemaps import build_keyword_sitemaps, refresh_keyword_sitemaps
+from ranker.pagecache import invalidate_keyword_pages
+from ranker.cache import get_cached_completion, get_cached_completions, store_completion, store_completions, prune_completions
+from django.db.models import Min, Max, F, Q
+from datetime import timedelta
 
 logger = get_task_logger(__name__)
 
+OPENAI_MODEL        = "gpt-3.5-turbo"
+OPENAI_TEMPERATURE  = 0.6
+KEYWORD_PROMPT = "If a user searches for @currentKeyword, what is their user intent, how would you rephrase this as a natural language question, please provide a thorough and detailed answer to the natural language question, what was their likely previous query, and what could be their next query? Provide your response as a simple JSON object, with keys \"user_intent\", \"natural_language_question\", \"ai_answer\", \"likely_previous_queries\", and \"likely_next_queries\". If this is likely to be their first or last query in their journey, answer \"none\" in the field"
+KEYWORD_RESPONSE_FIELDS = ['user_intent', 'natural_language_question', 'ai_answer', 'likely_previous_queries', 'likely_next_queries']
 
-@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 8}, rate_limit='500/m')
-def call_openai(self, prompt):
-    openai.api_key = os.getenv("OPENAI_API_KEY")
+def openai_messages(prompt):
     message_array = [{"role": "system", "content": "You are a helpful assistant."}] #by using async we forgo ability to have each message be dependent on previous messages and there is no guarantee of time order
     message_array.append({"role": "user", "content": prompt})
+    return message_array
+
+def keyword_prompt(keyword):
+    return KEYWORD_PROMPT.replace("@currentKeyword", keyword)
+
+def parse_keyword_response(api_response):
+    # Pull the JSON object out of the response and return only the columns we store on Keyword. Raises if anything is missing.
+    start_pos   = api_response.find('{')
+    end_pos     = api_response.rfind('}')
+    json_string = api_response[start_pos:end_pos+1]
+    json_object = json.loads(json_string)
+    return {field: json_object[field] for field in KEYWORD_RESPONSE_FIELDS}
+
+
+def has_json_object(api_response):
+    # Same extraction the response savers use: the text between the first '{' and the last '}' must parse
+    try:
+        json.loads(api_response[api_response.find('{'):api_response.rfind('}')+1])
+        return True
+    except ValueError:
+        return False
+
+def settle_token_usage(rate_limiter, estimated_tokens, response):
     try:
-        response = openai.ChatCompletion.create(model="gpt-3.5-turbo", messages=message_array, temperature=0.6,)
+        rate_limiter.adjust(response['usage']['total_tokens'] - estimated_tokens)
+    except (KeyError, TypeError):
+        pass
+
+
+# Rate limiting is done by the shared token bucket rather than Celery's rate_limit, which is enforced per worker
+@shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 8})
+def call_openai(self, prompt, expect_json=False):
+    # expect_json is set by callers that parse a JSON object out of the answer, so a malformed one isn't cached and the
+    # same prompt is asked again next time instead of returning the bad answer forever
+    cached_response = get_cached_completion(OPENAI_MODEL, OPENAI_TEMPERATURE, prompt)
+    if cached_response is not None:
+        return cached_response
+
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    message_array = openai_messages(prompt)
+    rate_limiter = openai_rate_limiter(OPENAI_MODEL, openai.api_key)
+    estimated_tokens = estimate_tokens(prompt)
+    rate_limiter.acquire(estimated_tokens)
+    try:
+        with openai_concurrency.slot():
+            response = openai.ChatCompletion.create(model=OPENAI_MODEL, messages=message_array, temperature=OPENAI_TEMPERATURE,)
+        settle_token_usage(rate_limiter, estimated_tokens, response)
     except openai.error.APIError as e:
         #Handle API error here, e.g. retry or log
         print(f"OpenAI API returned an API Error: {e}")
@@ -37,7 +94,10 @@ def call_openai(self, prompt):
         logger.warning("OpenAI API request exceeded rate limit: %s", e)
         raise e 
     try:
-        return response['choices'][0]['message']['content']
+        content = response['choices'][0]['message']['content']
+        if not expect_json or has_json_object(content):
+            store_completion(OPENAI_MODEL, OPENAI_TEMPERATURE, prompt, content)
+        return content
     except:
         print(f"Couldn't get a response. We retried several times. Sorry. Better luck next time.")
         logger.warning("Multiple attempts failed, response: %s", response)
@@ -84,35 +144,40 @@ def save_keyword_answer(api_response, ai_model_id, keyword_id):
         keyword = keyword,
         ai_model = ai_model
     )
-
-@shared_task(queue="express")
-def save_keyword_response(api_response, keyword_id):
-    keyword = Keyword.objects.get(id = keyword_id)
-    try:
-        start_pos   = api_response.find('{')
-        end_pos     = api_response.rfind('}')
-        json_string = api_response[start_pos:end_pos+1]
-        json_object = json.loads(json_string)
-
-        keyword.user_intent                 = json_object['user_intent']
-        keyword.natural_language_question   = json_object['natural_language_question']
-        keyword.ai_answer                   = json_object['ai_answer']
-        keyword.likely_previous_queries     = json_object['likely_previous_queries']
-        keyword.likely_next_queries         = json_object['likely_next_queries']
-
-        keyword.answered_at = timezone.now()
-        keyword.save()
-        print(f"{keyword} took {(keyword.answered_at-keyword.requested_at).total_seconds()} seconds.")
-        # Remove one from the pending keywords stat and add one to the answered keywords stat
-        add_value('keywords_pending' , -1)
-        add_value('keywords_answered',  1)
-
-        return "Keyword saved"
-    except:
-        print("Couldn't assign response to columns. Resetting requested_at to null.")
-        keyword.requested_at = None
-        keyword.save()
-        return "Keyword not saved"
+    invalidate_keyword_pages([keyword_id])
+
+def write_keyword_responses(responses, lease_token):
+    # responses is {keyword_id: (fields, answered_at)}, with fields None when the response couldn't be parsed.
+    # Only keywords still pending under this batch's lease are written: one whose lease expired and was claimed again
+    # belongs to the new claim. Answers are written with one bulk update; the keyword status trigger moves the statistics.
+    with transaction.atomic():
+        owned = set(
+            Keyword.objects.select_for_update().filter(id__in=list(responses), status='pending', lease_token=lease_token)
+            .order_by('id').values_list('id', flat=True)
+        )
+        answered = []
+        failed = []
+        for keyword_id, (fields, answered_at) in responses.items():
+            if keyword_id not in owned:
+                continue
+            if fields:
+                answered.append(Keyword(id=keyword_id, status='answered', lease_expires_at=None, lease_token=None, related_at=None, answered_at=answered_at, updated_at=answered_at, **fields))
+            else:
+                failed.append(keyword_id)
+
+        Keyword.objects.bulk_update(answered, KEYWORD_RESPONSE_FIELDS + ['status', 'lease_expires_at', 'lease_token', 'related_at', 'answered_at', 'updated_at'], batch_size=1000)
+        if failed:
+            # Failed keywords go back to the available pool so a later refill can pick them up again
+            Keyword.objects.filter(id__in=failed, status='pending', lease_token=lease_token).update(status='available', requested_at=None, lease_expires_at=None, lease_token=None)
+    link_answered_brands(answered)
+    invalidate_keyword_pages([keyword.id for keyword in answered])
+    return answered, failed
+
+def link_answered_brands(keywords):
+    # Incremental brand indexing: only the new answers are matched, against the brands that are already indexed
+    if not keywords:
+        return 0
+    return link_keyword_brands([keyword.id for keyword in keywords])
 
 @shared_task(queue="express")
 def save_business_json(api_response, domain_id):
@@ -176,43 +241,51 @@ def save_business_json(api_response, domain_id):
 
 
 @shared_task(queue="steamroller")
-def index_brands(batch_size):
-    print(f'Batch size: {batch_size}')
-    if Brand.objects.filter(keyword_indexed_at__exact=None).count() > 0:
-        brand_list = Brand.objects.filter(keyword_indexed_at__exact=None)[:batch_size]
-    else:
-        brand_list = Brand.objects.all().order_by('keyword_indexed_at')[:batch_size]
-    print(f"Found {len(brand_list)} brands")
-
-    for brand in brand_list:
-        brand.indexing_requested_at = timezone.now()
-        brand.keyword_indexed_at = None
-    Brand.objects.bulk_update(brand_list, ['indexing_requested_at', 'keyword_indexed_at'])
-
-    i = 0
-    for brand in brand_list:
-        i += 1
-        start_time = timezone.now()
-        # keyword_list = Keyword.objects.filter(ai_answer__icontains=brand.brand)
-        search_query = SearchQuery(brand.brand, search_type="websearch")
-        keyword_count = Keyword.objects.filter(search_vector=search_query).count()
-
-        if keyword_count > 50000:
-            print(f"Too many matches ({keyword_count}). Likely a generic brand. Deleting: {brand.brand}")
-            brand.delete()
-            continue
-        
-        keyword_list = Keyword.objects.filter(search_vector=search_query)
-
-        brand.keyword.add(*keyword_list)
-        brand.keyword_indexed_at = timezone.now()
-        brand.save()
-        end_time = timezone.now()
-        print(f"({i}/{len(brand_list)} - {int((end_time-start_time).total_seconds())} sec - {timezone.now()}) Brand ID {brand.pk} ({brand.brand}): {len(keyword_list)} keywords updated")
-
-
-
+def index_brands(batch_size, max_seconds=240, max_keywords=50000):
+    # Only new brands need a full scan: keywords answered later are matched as they are written (link_answered_brands).
+    # New brands are indexed in batches until they are caught up or the time budget (kept under the 5 minute schedule) runs out.
+    start_time = timezone.now()
+    indexed = 0
+    while (timezone.now() - start_time).total_seconds() < max_seconds:
+        brand_ids = list(Brand.objects.filter(keyword_indexed_at=None).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not brand_ids:
+            break
+        indexed += index_brand_batch(brand_ids, max_keywords)
+
+    end_time = timezone.now()
+    print(f"Indexed {indexed} new brands in {(end_time-start_time).total_seconds()} seconds")
+    return f"Indexed {indexed} new brands"
+
+def index_brand_batch(brand_ids, max_keywords):
+    batch_start = timezone.now()
+    Brand.objects.filter(id__in=brand_ids).update(indexing_requested_at=batch_start)
+
+    counts = count_brand_matches(brand_ids, max_keywords)
+    generic = [brand_id for brand_id, count in counts.items() if count > max_keywords]
+    if generic:
+        print(f"Too many matches (over {max_keywords}). Likely generic brands. Deleting: {list(Brand.objects.filter(id__in=generic).values_list('brand', flat=True))}")
+        Brand.objects.filter(id__in=generic).delete()
+
+    brand_ids = [brand_id for brand_id in counts if brand_id not in generic]
+    linked = link_brand_keywords(brand_ids)
+    Brand.objects.filter(id__in=brand_ids).update(keyword_indexed_at=timezone.now())
+    print(f"({int((timezone.now()-batch_start).total_seconds())} sec - {timezone.now()}) Indexed {len(brand_ids)} brands: {linked} keyword links added")
+    return len(brand_ids)
 
+@shared_task(queue="steamroller")
+def import_keywords(keywordfile_id):
+    # Background import for a keyword file, so uploads never hold a web worker. Progress is read from the KeywordFile row.
+    # Only the task that moves the file from queued to running imports it; a duplicate task finds it claimed and stops.
+    if not start_keyword_file_import(keywordfile_id):
+        return "Keyword file is not queued"
+    try:
+        keywords_inserted, positions_loaded, seconds = import_keyword_file(keywordfile_id)
+    except Exception as e:
+        # rows_processed keeps the checkpoint, so queueing the file again resumes where this run stopped
+        KeywordFile.objects.filter(id=keywordfile_id).update(import_status='failed', import_error=repr(e), import_lease_expires_at=None)
+        raise
+    KeywordFile.objects.filter(id=keywordfile_id).update(import_status='done', import_lease_expires_at=None)
+    return f"{keywords_inserted} new keywords, {positions_loaded} positions in {seconds} seconds"
 
 @shared_task(queue="steamroller")
 def refill_keyword_queue():
@@ -224,72 +297,199 @@ def refill_keyword_queue():
         max_queue = 300
 
     kw_batch_size = kw_batch_size
-    queued = Keyword.objects.filter(answered_at__isnull=True).filter(requested_at__isnull=False).count()
+    queued = get_value('keywords_pending')
 
     if queued + kw_batch_size >= max_queue:
         kw_batch_size = max(max_queue-queued, 0)
     
-    keyword_list = Keyword.objects.filter(requested_at=None)[:kw_batch_size]
     logger.info(f"Requesting responses for {kw_batch_size} keywords.")
-    # Remove batch size from keywords available to be queued stat and add to pending keywords stat
-    add_value('keywords_available'  ,   -kw_batch_size)
-    add_value('keywords_pending'    ,    kw_batch_size)
-
-    item_list = []
-    for keyword in keyword_list:
-        keyword.requested_at = timezone.now()
-        item_list.append(keyword)
-    Keyword.objects.bulk_update(item_list, ["requested_at"], batch_size=5000)
-
-    for keyword in keyword_list:
-        prompt = "If a user searches for @currentKeyword, what is their user intent, how would you rephrase this as a natural language question, please provide a thorough and detailed answer to the natural language question, what was their likely previous query, and what could be their next query? Provide your response as a simple JSON object, with keys \"user_intent\", \"natural_language_question\", \"ai_answer\", \"likely_previous_queries\", and \"likely_next_queries\". If this is likely to be their first or last query in their journey, answer \"none\" in the field"
-        prompt = prompt.replace("@currentKeyword", keyword.keyword)
-        call_openai.apply_async( (prompt,), link=save_keyword_response.s(keyword.id)) #note the comma in arguments, critical to imply tuple, otherwise thinks array, passes response as first argument
+    lease_token, keyword_ids = claim_keywords(kw_batch_size)
+
+    queue_keyword_batches(keyword_ids, lease_token)
+
+def queue_keyword_batches(keyword_ids, lease_token):
+    # One dispatcher task per batch instead of a call_openai task per keyword. Every batch carries the claim's lease token.
+    batch_size = settings.OPENAI_DISPATCH_BATCH_SIZE
+    for i in range(0, len(keyword_ids), batch_size):
+        dispatch_keyword_batch.delay(keyword_ids[i:i+batch_size], str(lease_token))
+
+@retry(
+    retry=retry_if_exception_type((openai.error.RateLimitError, openai.error.APIError, openai.error.APIConnectionError, openai.error.Timeout, openai.error.ServiceUnavailableError)),
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def acall_openai(prompt):
+    rate_limiter = openai_rate_limiter(OPENAI_MODEL, openai.api_key)
+    estimated_tokens = estimate_tokens(prompt)
+    await rate_limiter.aacquire(estimated_tokens)
+    async with openai_concurrency.aslot():
+        response = await openai.ChatCompletion.acreate(model=OPENAI_MODEL, messages=openai_messages(prompt), temperature=OPENAI_TEMPERATURE,)
+    await asyncio.to_thread(settle_token_usage, rate_limiter, estimated_tokens, response)
+    return response['choices'][0]['message']['content']
+
+async def acall_openai_batch(prompts, concurrency):
+    # Drive many completions at once from a single process. The semaphore bounds in-flight requests for this process,
+    # the adaptive limit bounds them across all workers, and the shared session reuses connections.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_call(key, prompt):
+        async with semaphore:
+            try:
+                return key, await acall_openai(prompt)
+            except Exception as e:
+                logger.warning("OpenAI request failed for %s: %s", key, e)
+                return key, None
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        results = await asyncio.gather(*[bounded_call(key, prompt) for key, prompt in prompts.items()])
+    return dict(results)
+
+async def keep_keyword_leases(keyword_ids, lease_token):
+    # Heartbeat for a running batch, so the reaper only reclaims keywords whose worker has actually gone away
+    while True:
+        await asyncio.sleep(settings.KEYWORD_LEASE_SECONDS / 3)
+        await sync_to_async(renew_keyword_leases)(keyword_ids, lease_token)
+
+async def acall_openai_leased(keyword_ids, lease_token, prompts):
+    heartbeat = asyncio.create_task(keep_keyword_leases(keyword_ids, lease_token))
+    try:
+        return await acall_openai_batch(prompts, settings.OPENAI_DISPATCH_CONCURRENCY)
+    finally:
+        heartbeat.cancel()
+
+@shared_task
+def dispatch_keyword_batch(keyword_ids, lease_token):
+    start_time = timezone.now()
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    # The batch may have waited in the broker, so its leases are renewed before any work starts. Keywords it no longer
+    # holds (reaped, then claimed again or answered) are skipped.
+    renew_keyword_leases(keyword_ids, lease_token)
+    keywords = list(Keyword.objects.filter(id__in=keyword_ids, status='pending', lease_token=lease_token).only('id', 'keyword', 'requested_at'))
+    prompts = {keyword.id: keyword_prompt(keyword.keyword) for keyword in keywords}
+
+    # Only prompts we haven't seen before go to the API
+    cached = get_cached_completions(OPENAI_MODEL, OPENAI_TEMPERATURE, prompts.values())
+    responses = {keyword_id: cached[prompt] for keyword_id, prompt in prompts.items() if prompt in cached}
+    uncached = {keyword_id: prompt for keyword_id, prompt in prompts.items() if prompt not in cached}
+    responses.update(asyncio.run(acall_openai_leased(list(prompts), lease_token, uncached)))
+
+    parsed = {}
+    answered_at = timezone.now()
+    for keyword in keywords:
+        try:
+            parsed[keyword.id] = (parse_keyword_response(responses[keyword.id]), answered_at)
+        except:
+            parsed[keyword.id] = (None, answered_at)
+    answered, failed = write_keyword_responses(parsed, lease_token)
+    # Cache only responses that parsed, so a malformed answer is asked for again next time
+    store_completions(OPENAI_MODEL, OPENAI_TEMPERATURE, {prompts[keyword.id]: responses[keyword.id] for keyword in answered if keyword.id in uncached})
+
+    end_time = timezone.now()
+    logger.info(f"Dispatched {len(keywords)} keywords in {(end_time-start_time).total_seconds()} seconds: {len(answered)} answered, {len(failed)} failed.")
+    return f"{len(answered)} keywords saved, {len(failed)} keywords not saved"
  
+@shared_task(queue="steamroller")
+def refresh_related_keywords(batch_size=1000, chunk=100, max_seconds=240):
+    # Computes related links for newly answered keywords first (related_at is cleared when an answer is written), then
+    # recomputes the oldest ones so they pick up keywords answered since. Runs until caught up or out of time.
+    start_time = timezone.now()
+    stale_before = start_time - timedelta(days=settings.RELATED_KEYWORDS_REFRESH_DAYS)
+    related = 0
+    while (timezone.now() - start_time).total_seconds() < max_seconds:
+        keywords = list(
+            Keyword.objects.filter(answered_at__isnull=False).filter(Q(related_at__isnull=True) | Q(related_at__lt=stale_before))
+            .order_by(F('related_at').asc(nulls_first=True)).values_list('id', 'likely_previous_queries', 'likely_next_queries')[:batch_size]
+        )
+        if not keywords:
+            break
+        for i in range(0, len(keywords), chunk):
+            queries = {keyword_id: related_queries(previous, following) for keyword_id, previous, following in keywords[i:i+chunk]}
+            relate_keywords(queries, settings.RELATED_KEYWORDS_PER_QUERY, settings.RELATED_KEYWORDS_LIMIT)
+            invalidate_keyword_pages(list(queries))
+        related += len(keywords)
+
+    end_time = timezone.now()
+    logger.info(f"Related {related} keywords in {(end_time-start_time).total_seconds()} seconds.")
+    return f"Related {related} keywords"
+
 @shared_task(queue="steamroller")
 def build_sitemaps():
-    # Generic implementation to build sitemaps for a model
-    def sitemaps_for_model(category, objects, batch_size=10000):
-        num_pages = int(objects.count()/batch_size) + 1 
-        Sitemap.objects.filter(category=category).delete()
-        
-        for page in range(num_pages):
-
-            with default_storage.open(f'sitemaps/{category}/sitemap-{category}-{1000+page}.xml', 'w') as the_file:
-                the_file.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
-                the_file.write("<urlset xmlns=\"http://www.sitemaps.org/schemas/sitemap/0.9\" xmlns:xhtml=\"http://www.w3.org/1999/xhtml\">\n")
-                
-                for obj in objects[batch_size*page:batch_size*(page+1)]:
-                    the_file.write("<url>\n")
-                    the_file.write(f"\t<loc>https://topranks.ai{obj.get_absolute_url()}</loc>\n")
-                    the_file.write(f"\t<lastmod>{obj.updated_at.strftime('%Y-%m-%d')}</lastmod>\n")
-                    the_file.write("</url>\n")
-                the_file.write("</urlset>")
-        
-            redirect = "https://topranks.ai/" + the_file.obj.key
-            sitemap = Sitemap.objects.create(url=redirect, category=category)
-            print(f"Sitemap ({sitemap.category}): {sitemap.url}")
+    built = build_keyword_sitemaps()
+    return f"Built {built} keyword sitemaps"
 
-    #Each model desired, pass in category and context
-    keywords = Keyword.objects.filter(answered_at__isnull=False)
-    sitemaps_for_model('keywords', keywords)
+@shared_task(queue="steamroller")
+def refresh_sitemaps():
+    refreshed = refresh_keyword_sitemaps()
+    return f"Refreshed {refreshed} keyword sitemaps"
 
 @shared_task(queue="steamroller")
-def keyword_volumes():
+def keyword_volumes(incremental=False, chunk=100000):
+    # Refreshes search_volume and num_brands with set based updates. A full run walks every keyword id range; an
+    # incremental run only recomputes keywords with position snapshots or brand links added since the last run.
+    # The id watermarks are read before the work starts, so rows written during a run are picked up by the next one.
+    # Id watermarks can't see snapshots updated in place by an import's merge, or rows from transactions that commit after
+    # the watermark has moved past their ids. Those are picked up by the daily full run (keyword_volumes_full in the beat schedule).
     print("Starting task: Keyword Volumes")
-    key_list = Keyword.objects.filter(search_volume=None).all().values_list('id', flat=True)
-    key_list = list(set(key_list))
-    batch_size = 10000
-    num_runs = int(len(key_list)/batch_size)+1
-    for i in range(num_runs):
-        loop_list = key_list[i*batch_size:(i+1)*batch_size]
-        keys = Keyword.objects.filter(pk__in=loop_list).annotate(sv=Avg('keywordposition__search_volume'))
-        for key in keys:
-            key.search_volume = key.sv 
-        Keyword.objects.bulk_update(keys, ['search_volume'])
-
-        keys = Keyword.objects.filter(pk__in=loop_list).annotate(brands=Count('brandkeyword'))
-        for key in keys:
-            key.num_brands = key.brands 
-        Keyword.objects.bulk_update(keys, ['num_brands'])
-        print(f"[{i}/{num_runs}] Updated {len(keys)} keywords with search volume and number of brands from {min(loop_list)} to {max(loop_list)}")
\ No newline at end of file
+    start_time = timezone.now()
+    snapshot_max = PositionSnapshot.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    brandkeyword_max = BrandKeyword.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    updated = 0
+    if incremental:
+        watermarks = get_values('keyword_volumes_snapshot_id', 'keyword_volumes_brandkeyword_id')
+        keyword_ids = sorted(
+            set(PositionSnapshot.objects.filter(id__gt=watermarks['keyword_volumes_snapshot_id'], id__lte=snapshot_max).values_list('keyword_id', flat=True).distinct())
+            | set(BrandKeyword.objects.filter(id__gt=watermarks['keyword_volumes_brandkeyword_id'], id__lte=brandkeyword_max).values_list('keyword_id', flat=True).distinct())
+        )
+        for i in range(0, len(keyword_ids), chunk):
+            updated += refresh_keyword_volumes(keyword_ids=keyword_ids[i:i+chunk])
+        print(f"Updated {updated} of {len(keyword_ids)} changed keywords with search volume and number of brands")
+    else:
+        bounds = Keyword.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is not None:
+            for start_id in range(bounds['min_id'], bounds['max_id'] + 1, chunk):
+                updated += refresh_keyword_volumes(start_id, start_id + chunk)
+                print(f"Updated {updated} keywords with search volume and number of brands up to id {min(start_id + chunk - 1, bounds['max_id'])} of {bounds['max_id']}")
+    set_value('keyword_volumes_snapshot_id', snapshot_max)
+    set_value('keyword_volumes_brandkeyword_id', brandkeyword_max)
+    end_time = timezone.now()
+    logger.info(f"Refreshed volumes for {updated} keywords in {(end_time-start_time).total_seconds()} seconds.")
+    if not incremental:
+        score_keywords()
+    return f"Updated {updated} keywords"
+
+@shared_task(queue="steamroller")
+def score_keywords(chunk=100000):
+    # Keeps the priority ordering used by claim_keywords current. Scored one id range per statement so no single
+    # update holds locks on a large share of the table.
+    start_time = timezone.now()
+    bounds = Keyword.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return "No keywords to score"
+    rescored = 0
+    for start_id in range(bounds['min_id'], bounds['max_id'] + 1, chunk):
+        rescored += rescore_keywords(start_id, start_id + chunk)
+    end_time = timezone.now()
+    logger.info(f"Rescored {rescored} keywords in {(end_time-start_time).total_seconds()} seconds.")
+    return f"Rescored {rescored} keywords"
+
+@shared_task(queue="steamroller")
+def prune_completion_cache():
+    expired, evicted = prune_completions()
+    print(f"Completion cache pruned: {expired} expired, {evicted} evicted.")
+
+@shared_task(queue="express")
+def compact_statistics():
+    keys = fold_statistic_deltas()
+    return f"Compacted deltas for {keys} statistics"
+
+@shared_task(queue="express")
+def reap_keyword_leases():
+    released = release_expired_keyword_leases()
+    return f"Returned {released} keywords with expired leases to the queue"
+
+@shared_task(queue="express")
+def reap_keyword_imports():
+    failed = release_expired_import_leases()
+    return f"Marked {failed} stalled keyword imports as failed"
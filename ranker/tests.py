@@ -1,3 +1,378 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from django.contrib.postgres.search import SearchVector
+from django.urls import reverse
+from django.db.models import Q
 
-# Create your tests here.
+from ranker.models import CompletionCache, Sitemap, Domain, KeywordFile, Keyword, Brand, BrandKeyword, PositionSnapshot, PositionUrl, upsert_keywords, upsert_lookup, claim_keywords, renew_keyword_leases, release_expired_keyword_leases, rescore_keywords, link_keyword_brands, release_expired_import_leases, refresh_keyword_volumes, KeywordPosition
+from ranker.tasks import call_openai, dispatch_keyword_batch, import_keywords, write_keyword_responses
+from ranker.views import KeywordDetailView
+from ranker.importing import import_rows
+from ranker.ratelimit import TokenBucket
+from ranker.connections import app_redis
+from ranker.sitemaps import SHARD_SIZE, build_keyword_sitemaps, refresh_keyword_sitemaps
+
+from datetime import timedelta
+from unittest import mock
+
+from accounts.models import User
+
+import asyncio, gzip, json, os, tempfile, threading, time, uuid
+
+def wait_for_lock_waiters(count, timeout=10):
+    # Blocks until count other backends are waiting on a lock, so a test can commit exactly while they wait
+    deadline = time.monotonic() + timeout
+    with connection.cursor() as cursor:
+        while time.monotonic() < deadline:
+            # Activity statistics are snapshotted once per transaction unless cleared
+            cursor.execute("SELECT pg_stat_clear_snapshot()")
+            cursor.execute("SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND pid <> pg_backend_pid()")
+            if cursor.fetchone()[0] >= count:
+                return True
+            time.sleep(0.05)
+    return False
+
+class UpsertTests(TestCase):
+    def test_upsert_keywords_returns_new_and_existing(self):
+        existing = Keyword.objects.create(keyword='existing keyword')
+        keyword_ids, inserted = upsert_keywords(['existing keyword', 'new keyword'])
+        self.assertEqual(inserted, 1)
+        self.assertEqual(keyword_ids['existing keyword'], existing.id)
+        self.assertEqual(keyword_ids['new keyword'], Keyword.objects.get(keyword='new keyword').id)
+
+    def test_upsert_lookup_returns_every_value(self):
+        existing = PositionUrl.objects.create(url='https://example.com/a')
+        url_ids = upsert_lookup(PositionUrl, 'url', ['https://example.com/a', 'https://example.com/b', 'https://example.com/b'])
+        self.assertEqual(url_ids['https://example.com/a'], existing.id)
+        self.assertEqual(set(url_ids), {'https://example.com/a', 'https://example.com/b'})
+        self.assertEqual(PositionUrl.objects.count(), 2)
+
+class ConcurrentUpsertTests(TransactionTestCase):
+    # Two imports racing on the same keys: the second one's insert waits for the first to commit, and the committed
+    # row is outside its statement snapshot. Every key must still resolve to the committed id.
+
+    def race(self, upsert, first_keys, second_keys):
+        results = {}
+        errors = []
+
+        def second_import():
+            try:
+                results['second'] = upsert(second_keys)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        with transaction.atomic():
+            results['first'] = upsert(first_keys)
+            thread = threading.Thread(target=second_import)
+            thread.start()
+            self.assertTrue(wait_for_lock_waiters(1))
+        thread.join(timeout=30)
+        self.assertFalse(errors)
+        return results['first'], results['second']
+
+    def test_racing_keyword_upserts(self):
+        (first_ids, first_inserted), (second_ids, second_inserted) = self.race(upsert_keywords, ['shared keyword'], ['another keyword', 'shared keyword'])
+        self.assertEqual(second_ids['shared keyword'], first_ids['shared keyword'])
+        self.assertIn('another keyword', second_ids)
+        self.assertEqual((first_inserted, second_inserted), (1, 1))
+
+    def test_racing_lookup_upserts(self):
+        upsert_urls = lambda urls: upsert_lookup(PositionUrl, 'url', urls)
+        first_ids, second_ids = self.race(upsert_urls, ['https://example.com/shared'], ['https://example.com/shared', 'https://example.com/other'])
+        self.assertEqual(second_ids['https://example.com/shared'], first_ids['https://example.com/shared'])
+        self.assertIn('https://example.com/other', second_ids)
+
+def answer_fields(answer):
+    return {'user_intent': 'intent', 'natural_language_question': 'question', 'ai_answer': answer, 'likely_previous_queries': [], 'likely_next_queries': []}
+
+class KeywordLeaseTests(TestCase):
+    def expire_leases(self):
+        Keyword.objects.filter(status='pending').update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_claim_takes_highest_priority_available_keywords(self):
+        low = Keyword.objects.create(keyword='low', priority=1)
+        high = Keyword.objects.create(keyword='high', priority=10)
+        Keyword.objects.create(keyword='answered', priority=100, status='answered')
+        lease_token, keyword_ids = claim_keywords(1)
+        self.assertEqual(keyword_ids, [high.id])
+        high.refresh_from_db()
+        self.assertEqual((high.status, high.lease_token), ('pending', lease_token))
+        self.assertIsNotNone(high.lease_expires_at)
+        self.assertEqual(claim_keywords(5)[1], [low.id])
+        self.assertEqual(claim_keywords(5)[1], [])
+
+    def test_renew_needs_the_claims_token(self):
+        Keyword.objects.create(keyword='leased')
+        lease_token, keyword_ids = claim_keywords(1)
+        self.assertEqual(renew_keyword_leases(keyword_ids, uuid.uuid4()), 0)
+        self.assertEqual(renew_keyword_leases(keyword_ids, lease_token), 1)
+
+    def test_reaper_frees_only_expired_leases(self):
+        expired = Keyword.objects.create(keyword='expired')
+        claim_keywords(1)
+        self.expire_leases()
+        current = Keyword.objects.create(keyword='current')
+        claim_keywords(1)
+        self.assertEqual(release_expired_keyword_leases(), 1)
+        expired.refresh_from_db()
+        current.refresh_from_db()
+        self.assertEqual((expired.status, expired.lease_token), ('available', None))
+        self.assertEqual(current.status, 'pending')
+
+    def test_stale_batch_cannot_write_a_reclaimed_keyword(self):
+        keyword = Keyword.objects.create(keyword='reclaimed')
+        stale_token, keyword_ids = claim_keywords(1)
+        self.expire_leases()
+        release_expired_keyword_leases()
+        current_token, _ = claim_keywords(1)
+
+        answered, failed = write_keyword_responses({keyword.id: (None, timezone.now())}, stale_token)
+        self.assertEqual((answered, failed), ([], []))
+        keyword.refresh_from_db()
+        self.assertEqual((keyword.status, keyword.lease_token), ('pending', current_token))
+
+        answered, failed = write_keyword_responses({keyword.id: (answer_fields('answer'), timezone.now())}, current_token)
+        self.assertEqual([k.id for k in answered], [keyword.id])
+        keyword.refresh_from_db()
+        self.assertEqual((keyword.status, keyword.ai_answer, keyword.lease_token), ('answered', 'answer', None))
+
+    def test_failed_response_returns_keyword_to_the_pool(self):
+        keyword = Keyword.objects.create(keyword='failed')
+        lease_token, _ = claim_keywords(1)
+        answered, failed = write_keyword_responses({keyword.id: (None, timezone.now())}, lease_token)
+        self.assertEqual(failed, [keyword.id])
+        keyword.refresh_from_db()
+        self.assertEqual((keyword.status, keyword.lease_token, keyword.lease_expires_at), ('available', None, None))
+
+class DispatchKeywordBatchTests(TestCase):
+    def test_answers_are_saved_and_failures_returned_to_the_pool(self):
+        answered = Keyword.objects.create(keyword='rocket fuel')
+        malformed = Keyword.objects.create(keyword='rocket paint')
+        errored = Keyword.objects.create(keyword='rocket glue')
+        lease_token, keyword_ids = claim_keywords(3)
+
+        async def acreate(model, messages, temperature):
+            prompt = messages[-1]['content']
+            if 'rocket glue' in prompt:
+                raise ValueError("connection reset")
+            content = json.dumps(answer_fields('Use kerosene.')) if 'rocket fuel' in prompt else 'Sorry, I can not answer that.'
+            return {'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 100}}
+
+        with mock.patch('openai.ChatCompletion.acreate', side_effect=acreate) as api:
+            dispatch_keyword_batch.run(keyword_ids, str(lease_token))
+        self.assertEqual(api.call_count, 3)
+
+        answered.refresh_from_db()
+        self.assertEqual((answered.status, answered.ai_answer), ('answered', 'Use kerosene.'))
+        self.assertIsNotNone(answered.answered_at)
+        for keyword in (malformed, errored):
+            keyword.refresh_from_db()
+            self.assertEqual(keyword.status, 'available')
+        self.assertFalse(Keyword.objects.filter(Q(lease_token__isnull=False) | Q(lease_expires_at__isnull=False)).exists())
+        # Only the answer that parsed is cached
+        self.assertEqual(list(CompletionCache.objects.values_list('response', flat=True)), [json.dumps(answer_fields('Use kerosene.'))])
+
+class RescoreTests(TestCase):
+    def test_age_raises_keywords_without_search_volume(self):
+        new = Keyword.objects.create(keyword='new')
+        old = Keyword.objects.create(keyword='old')
+        Keyword.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(rescore_keywords(0, old.id + 1), 2)
+        new.refresh_from_db()
+        old.refresh_from_db()
+        self.assertEqual(new.priority, 0)
+        self.assertGreater(old.priority, 0)
+
+    def test_unchanged_scores_are_not_rewritten(self):
+        keyword = Keyword.objects.create(keyword='volume', search_volume=1000, num_brands=2)
+        self.assertEqual(rescore_keywords(0, keyword.id + 1), 1)
+        self.assertEqual(rescore_keywords(0, keyword.id + 1), 0)
+
+class KeywordVolumeTests(TestCase):
+    def test_keywords_without_snapshots_keep_their_volume(self):
+        domain = Domain.objects.create(domain='example.com')
+        legacy = Keyword.objects.create(keyword='legacy rockets', search_volume=500)
+        KeywordPosition.objects.create(domain=domain, keyword=legacy, domain_text='example.com', keyword_text='legacy rockets', search_volume=500)
+        current = Keyword.objects.create(keyword='current rockets', search_volume=500)
+        PositionSnapshot.objects.create(domain=domain, keyword=current, retrieved_on=timezone.now().date(), search_volume=700)
+        self.assertEqual(refresh_keyword_volumes(0, current.id + 1), 2)
+        legacy.refresh_from_db()
+        current.refresh_from_db()
+        self.assertEqual((legacy.search_volume, legacy.num_brands), (500, 0))
+        self.assertEqual((current.search_volume, current.num_brands), (700, 0))
+
+class BrandLinkTests(TestCase):
+    def test_new_answers_link_to_indexed_brands_only(self):
+        indexed = Brand.objects.create(brand='Acme Rockets', indexing_requested_at=timezone.now())
+        Brand.objects.create(brand='Globex')
+        answered = Keyword.objects.create(keyword='best rockets', ai_answer='Acme Rockets and Globex both sell rockets.')
+        Keyword.objects.create(keyword='other rockets', ai_answer='Acme Rockets are popular.')
+        Keyword.objects.update(search_vector=SearchVector('keyword', 'ai_answer', config='english'))
+        self.assertEqual(link_keyword_brands([answered.id]), 1)
+        self.assertEqual(link_keyword_brands([answered.id]), 0)
+        self.assertEqual(list(BrandKeyword.objects.values_list('brand_id', 'keyword_id')), [(indexed.id, answered.id)])
+
+class RelatedKeywordTests(TestCase):
+    def test_page_relates_a_newly_answered_keyword(self):
+        keyword = Keyword.objects.create(keyword='rocket fuel', answered_at=timezone.now(), likely_next_queries=['rocket engines'])
+        engines = Keyword.objects.create(keyword='rocket engines', answered_at=timezone.now())
+        Keyword.objects.update(search_vector=SearchVector('keyword', config='english'))
+        keyword.refresh_from_db()
+
+        view = KeywordDetailView()
+        view.object = keyword
+        view.request = None
+        view.kwargs = {}
+        self.assertEqual(view.get_context_data()['related_keywords'], [engines])
+        keyword.refresh_from_db()
+        self.assertIsNotNone(keyword.related_at)
+
+class CompletionCacheTests(TestCase):
+    def completion(self, content):
+        return {'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 10}}
+
+    def test_malformed_json_answers_are_not_cached(self):
+        with mock.patch('openai.ChatCompletion.create', return_value=self.completion('Sorry, no JSON today')):
+            self.assertEqual(call_openai.run('business prompt', expect_json=True), 'Sorry, no JSON today')
+        self.assertFalse(CompletionCache.objects.exists())
+
+        with mock.patch('openai.ChatCompletion.create', return_value=self.completion('Here it is: {"business_name": "Acme"}')):
+            call_openai.run('business prompt', expect_json=True)
+        self.assertEqual(CompletionCache.objects.get().response, 'Here it is: {"business_name": "Acme"}')
+
+    def test_text_answers_are_cached(self):
+        with mock.patch('openai.ChatCompletion.create', return_value=self.completion('Plain answer')):
+            call_openai.run('question')
+        self.assertEqual(CompletionCache.objects.get().response, 'Plain answer')
+
+class KeywordFilePrimaryTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create(email='reviewer@example.com'))
+        self.domain = Domain.objects.create(domain='example.com')
+
+    def make_primary(self, keywordfile):
+        with mock.patch('ranker.domains.views.import_keywords') as import_keywords:
+            self.client.get(reverse('keywordfile_make_primary', args=[self.domain.id, keywordfile.id]))
+        keywordfile.refresh_from_db()
+        return import_keywords.delay.call_count
+
+    def test_queues_an_unprocessed_file_once(self):
+        keywordfile = KeywordFile.objects.create(domain=self.domain, filepath='documents/keywords.csv')
+        self.assertEqual(self.make_primary(keywordfile), 1)
+        self.assertEqual((keywordfile.primary, keywordfile.import_status), (True, 'queued'))
+
+    def test_clicking_twice_queues_one_import(self):
+        keywordfile = KeywordFile.objects.create(domain=self.domain, filepath='documents/keywords.csv')
+        self.assertEqual(self.make_primary(keywordfile) + self.make_primary(keywordfile), 1)
+        self.assertEqual(keywordfile.import_status, 'queued')
+
+    def test_running_import_is_not_queued_again(self):
+        keywordfile = KeywordFile.objects.create(domain=self.domain, filepath='documents/keywords.csv', import_status='running')
+        self.assertEqual(self.make_primary(keywordfile), 0)
+        self.assertEqual((keywordfile.primary, keywordfile.import_status), (True, 'running'))
+
+    def test_duplicate_import_task_stops_without_importing(self):
+        keywordfile = KeywordFile.objects.create(domain=self.domain, filepath='documents/keywords.csv', import_status='queued')
+        with mock.patch('ranker.tasks.import_keyword_file', return_value=(1, 1, 0.1)) as import_keyword_file:
+            import_keywords.run(keywordfile.id)
+            import_keywords.run(keywordfile.id)
+        self.assertEqual(import_keyword_file.call_count, 1)
+        keywordfile.refresh_from_db()
+        self.assertEqual((keywordfile.import_status, keywordfile.import_lease_expires_at), ('done', None))
+
+    def test_stalled_import_can_be_queued_again(self):
+        keywordfile = KeywordFile.objects.create(domain=self.domain, filepath='documents/keywords.csv', import_status='running',
+                                                 import_lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(release_expired_import_leases(), 1)
+        self.assertEqual(self.make_primary(keywordfile), 1)
+        self.assertEqual(keywordfile.import_status, 'queued')
+
+class ImportRowsTests(TestCase):
+    def row(self, **values):
+        row = dict.fromkeys([
+            'Keyword', 'Position', 'Previous position', 'Search Volume', 'Keyword Difficulty', 'CPC', 'Traffic', 'Traffic (%)',
+            'Traffic Cost', 'Competition', 'Number of Results', 'URL', 'SERP Features by Keyword', 'Keyword Intents',
+            'Position Type', 'Timestamp', 'Trends',
+        ], '')
+        row.update(values)
+        return row
+
+    def test_long_position_types_are_truncated(self):
+        domain = Domain.objects.create(domain='example.com')
+        inserted, loaded = import_rows(domain, [self.row(**{'Keyword': 'rockets', 'Position': '3', 'Search Volume': '100', 'Position Type': 'Organic ' * 10, 'Timestamp': '2026-10-01'})])
+        self.assertEqual((inserted, loaded), (1, 1))
+        snapshot = PositionSnapshot.objects.get()
+        self.assertEqual(snapshot.type, ('Organic ' * 10)[:40])
+        self.assertEqual((snapshot.position, snapshot.search_volume), (3, 100))
+
+class TokenBucketTests(TestCase):
+    def setUp(self):
+        # 60 requests and 600 tokens a minute with one second of burst: 1 request and 10 tokens of capacity
+        self.bucket = TokenBucket('test-model', str(uuid.uuid4()), 60, 600, 1)
+        self.addCleanup(app_redis.delete, self.bucket.key)
+
+    def test_requests_beyond_capacity_wait(self):
+        self.assertEqual(self.bucket.try_acquire(1), 0)
+        self.assertGreater(self.bucket.try_acquire(1), 0)
+
+    def test_tokens_beyond_capacity_wait_and_adjust_returns_them(self):
+        bucket = TokenBucket('test-model', str(uuid.uuid4()), 6000, 600, 1)
+        self.addCleanup(app_redis.delete, bucket.key)
+        self.assertEqual(bucket.try_acquire(8), 0)
+        self.assertGreater(bucket.try_acquire(8), 0)
+        bucket.adjust(-8)
+        self.assertEqual(bucket.try_acquire(8), 0)
+
+    def test_async_acquire_keeps_the_event_loop_running(self):
+        # A slow Redis round trip must not stall other coroutines while a request waits for the bucket
+        def slow_try_acquire(tokens):
+            time.sleep(0.2)
+            return 0
+
+        async def acquire_while_ticking():
+            ticks = 0
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+            ticker = asyncio.create_task(tick())
+            await self.bucket.aacquire(1)
+            ticker.cancel()
+            return ticks
+
+        with mock.patch.object(self.bucket, 'try_acquire', side_effect=slow_try_acquire):
+            self.assertGreater(asyncio.run(acquire_while_ticking()), 5)
+
+class SitemapShardTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        storage = override_settings(MEDIA_ROOT=media_root.name, STORAGES={'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'}})
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.media_root = media_root.name
+        # Unlike the S3 storage, the file system storage only creates directories on save
+        os.makedirs(os.path.join(self.media_root, 'sitemaps/keywords'))
+
+    def shard_file(self, shard):
+        with gzip.open(os.path.join(self.media_root, f"sitemaps/keywords/sitemap-keywords-{1000+shard}.xml.gz")) as the_file:
+            return the_file.read().decode()
+
+    def test_refresh_rewrites_only_changed_shards(self):
+        first = Keyword.objects.create(id=1, keyword='first rocket', answered_at=timezone.now())
+        Keyword.objects.create(id=SHARD_SIZE + 1, keyword='second rocket', answered_at=timezone.now())
+        self.assertEqual(build_keyword_sitemaps(), 2)
+        self.assertIn(first.get_absolute_url(), self.shard_file(0))
+        self.assertEqual(refresh_keyword_sitemaps(), 0)
+
+        written = dict(Sitemap.objects.filter(category='keywords').values_list('shard', 'max_updated_at'))
+        Keyword.objects.create(id=SHARD_SIZE + 2, keyword='third rocket', answered_at=timezone.now())
+        self.assertEqual(refresh_keyword_sitemaps(), 1)
+        self.assertIn('third-rocket', self.shard_file(1))
+        refreshed = dict(Sitemap.objects.filter(category='keywords').values_list('shard', 'max_updated_at'))
+        self.assertEqual(refreshed[0], written[0])
+        self.assertGreater(refreshed[1], written[1])
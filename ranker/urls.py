@@ -14,6 +14,7 @@ urlpatterns = [
     path("sitemap.xml", views.sitemap, name="sitemap_index"),
     path("sitemap-static.xml", views.sitemap_static, name="sitemap_static"),
     path("media/sitemaps/<str:folder>/sitemap-<str:category>-<int:page_num>.xml", views.sitemap_redirect, name="sitemap_redirect"),
+    path("media/sitemaps/<str:folder>/sitemap-<str:category>-<int:page_num>.xml.gz", views.sitemap_redirect, {'extension': 'xml.gz'}, name="sitemap_redirect_gz"),
     path("robots.txt",TemplateView.as_view(template_name="ranker/robots.txt", content_type="text/plain")),  #add the robots.txt file
 
 
@@ -26,6 +27,7 @@ urlpatterns = [
 
 
     path('keywordfile_make_primary/<int:domain_id>/<int:keywordfile_id>/'   , login_required(domain_views.keywordfile_make_primary) , name='keywordfile_make_primary'),
+    path('keywordfile_progress/<int:keywordfile_id>/'                       , login_required(domain_views.keywordfile_progress)     , name='keywordfile_progress'),
     path('get_keyword_responses/<int:batch_multiplier>/'                    , login_required(domain_views.get_keyword_responses)    , name='get_keyword_responses'),
     path('get_business_data/'                                               , login_required(domain_views.get_business_data)        , name='get_business_data'),
     path('index_brands/'                                                    , login_required(domain_views.index_brands)             , name='index_brands'),
@@ -7,21 +7,30 @@ from django.core.paginator import (Paginator, EmptyPage, PageNotAnInteger,)
 from django.core.management import call_command
 from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
 from django.views.generic import TemplateView, FormView
 from django.views.generic.detail import SingleObjectMixin
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.contrib import messages as djmessages
+from django.contrib.messages import get_messages
 from django.views import generic, View
 from django.urls import reverse, reverse_lazy
 from _keenthemes.__init__ import KTLayout
 from _keenthemes.libs.theme import KTTheme
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
 from django.db.models import F, Max
-from django.db import transaction
 
-from .models import Domain, KeywordFile, Conversation, Template, TemplateItem, Message, Project, ProjectUser, ProjectDomain, AIModel, Keyword, Brand, Statistic, add_value, Sitemap
+from .models import Domain, KeywordFile, Conversation, Template, TemplateItem, Message, Project, ProjectUser, ProjectDomain, AIModel, Keyword, Brand, get_values, release_expired_keyword_leases, Sitemap, related_queries, relate_keywords
 from .forms import KeywordFileForm, TemplateItemForm, MessageForm, TemplateForm, AddDomainToProjectForm, CreateConversationsForm
 from ranker.tasks import call_openai, save_keyword_answer
+from ranker.concurrency import openai_concurrency
+from ranker.cache import cache_stats
+from ranker.sitemaps import sitemap_lastmod, sitemap_etag, cached_sitemap
+from ranker.pagecache import get_keyword_page, store_keyword_page
 
 import csv
 import os
@@ -36,18 +45,24 @@ logger = logging.getLogger(__name__)
 broker = redis.Redis(host=os.getenv("REDIS_HOST"), port=6379, db=0, password=os.getenv("REDIS_PASS"))
 backend  = redis.Redis(host=os.getenv("REDIS_HOST"), port=6379, db=1, password=os.getenv("REDIS_PASS"))
 
+# Crawlers poll the sitemaps constantly. The rendered XML and its Last-Modified are cached until the next build changes
+# a Sitemap row, and conditional requests get a 304 without rendering anything.
+@cache_control(public=True, max_age=1800)
+@condition(etag_func=lambda request: sitemap_etag('index'), last_modified_func=lambda request: sitemap_lastmod())
 def sitemap(request):
-    context = {}
-    context['sitemap_index'] = Sitemap.objects.all().exclude(category__exact='static')
-    return render(request, 'ranker/sitemap_index.xml', context, content_type='application/xml' )
+    content = cached_sitemap('sitemap:index', lambda: render_to_string('ranker/sitemap_index.xml', {'sitemap_index': Sitemap.objects.all().exclude(category__exact='static')}))
+    return HttpResponse(content, content_type='application/xml')
 
+@cache_control(public=True, max_age=1800)
+@condition(etag_func=lambda request: sitemap_etag('static'), last_modified_func=lambda request: sitemap_lastmod())
 def sitemap_static(request):
-    context = {}
-    context['sitemap_static'] = Sitemap.objects.filter(category__exact='static')
-    return render(request, 'ranker/sitemap_static.xml', context, content_type='application/xml' )
+    content = cached_sitemap('sitemap:static', lambda: render_to_string('ranker/sitemap_static.xml', {'sitemap_static': Sitemap.objects.filter(category__exact='static')}))
+    return HttpResponse(content, content_type='application/xml')
 
-def sitemap_redirect(request, folder, category, page_num):
-    return redirect(f"https://topranks-media-public.s3.us-east-2.amazonaws.com/media/sitemaps/{folder}/sitemap-{category}-{page_num}.xml")
+# Shard file names are stable, so the redirect can be cached by crawlers and CDNs
+@cache_control(public=True, max_age=86400)
+def sitemap_redirect(request, folder, category, page_num, extension='xml'):
+    return redirect(f"https://topranks-media-public.s3.us-east-2.amazonaws.com/media/sitemaps/{folder}/sitemap-{category}-{page_num}.{extension}")
 
 class TemplateListView(generic.ListView):
     model = Template
@@ -62,18 +77,18 @@ class TemplateListView(generic.ListView):
 
 class KeywordListView(generic.ListView):
     model = Keyword
-    queryset = Keyword.objects.filter(answered_at__isnull=False).order_by('-answered_at')[:500]
+    queryset = Keyword.objects.filter(status='answered').order_by('-answered_at')[:500]
     paginate_by = 100
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context = KTLayout.init(context) # A function to init the global layout. It is defined in _keenthemes/__init__.py file
-        context['keywords_total']       = Statistic.objects.get(key="keywords_total").value
-        context['keywords_available']   = Statistic.objects.get(key="keywords_available").value
-        context['keywords_pending']     = Statistic.objects.get(key="keywords_pending").value
-        context['keywords_answered']    = Statistic.objects.get(key="keywords_answered").value
+        context.update(get_values('keywords_total', 'keywords_available', 'keywords_pending', 'keywords_answered'))
         context['broker_size'] = broker.llen('celery')
         context['backend_size'] = backend.dbsize()
+        context['openai_concurrency_limit'] = int(openai_concurrency.limit())
+        context['openai_in_flight'] = openai_concurrency.in_flight()
+        context['completion_cache'] = cache_stats()
         if os.getenv("ENVIRONMENT") == "production":
             context['kw_batch_size'] = 10000
         else:
@@ -90,24 +105,10 @@ def keyword_search(request):
     return render(request, 'ranker/keyword_list.html', {'keyword_list': queryset, 'kw_batch_size': 10000})
 
 def reset_keyword_queue(request):
-    pending_keywords = Keyword.objects.filter(answered_at__isnull=True).filter(requested_at__isnull=False)
-    # Add pending keywords back to keywords available to be queued stat
-    add_value('keywords_available', pending_keywords.count())
-
-    # Reset pending keywords stat to 0 (can't use add_value helper because we're setting to 0 instead of adding)
-    with transaction.atomic():
-        stat = Statistic.objects.select_for_update().get(key='keywords_pending')
-        stat.value = 0
-        stat.save()
-    # Flush Redis cache and results
-    broker.flushdb()
-    backend.flushdb()
-    # Unset each individual keywords requested at value
-    item_list= []
-    for keyword in pending_keywords:
-        keyword.requested_at = None
-        item_list.append(keyword)
-    Keyword.objects.bulk_update(item_list, ["requested_at"], batch_size=10000)
+    # Runs the lease reaper now instead of waiting for the beat schedule. Only keywords whose lease has run out are freed,
+    # so batches still in flight and every other queued task are left alone.
+    released = release_expired_keyword_leases()
+    djmessages.success(request, f'Returned {released} keywords with expired leases to the queue')
     return redirect('keyword_list')
 
 class KeywordDetailView(generic.DetailView):
@@ -115,41 +116,48 @@ class KeywordDetailView(generic.DetailView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        keyword = self.get_object()
-        related_keywords = []
-        queries = []
-
-        if type(keyword.likely_previous_queries) is str and keyword.likely_previous_queries != 'none':
-            queries.append(keyword.likely_previous_queries)
-        if type(keyword.likely_previous_queries) is list:
-            for q in keyword.likely_previous_queries:
-                queries.append(q)
-        if type(keyword.likely_next_queries) is str and keyword.likely_next_queries != 'none':
-            queries.append(keyword.likely_next_queries)
-        if type(keyword.likely_next_queries) is list:
-            for q in keyword.likely_next_queries:
-                queries.append(q)
-
-        for query in queries:
-            search_query = SearchQuery(query, search_type="websearch")
-            related_kws = Keyword.objects.annotate(rank=SearchRank(F("search_vector"), search_query)).filter(search_vector=search_query).exclude(id=keyword.id).order_by("-rank")[:3]
-            for kw in related_kws:
-                if kw in related_keywords:
-                    continue #Used to have distinct list, alternatively try using set(related_keywords)
-                related_keywords.append(kw)               
-
-        context['related_keywords'] = related_keywords
+        keyword = self.object
+        # Precomputed by ranker.tasks.refresh_related_keywords, best first. A keyword answered since its last run has no
+        # links yet, so they are computed now instead of leaving the page without them until the task catches up.
+        if keyword.answered_at and keyword.related_at is None:
+            queries = related_queries(keyword.likely_previous_queries, keyword.likely_next_queries)
+            relate_keywords({keyword.id: queries}, settings.RELATED_KEYWORDS_PER_QUERY, settings.RELATED_KEYWORDS_LIMIT)
+        context['related_keywords'] = [link.related for link in keyword.related_links.select_related('related').only('keyword', 'related__keyword').order_by('-score', 'related_id')]
         context['ai_models'] = AIModel.objects.all()
         context['answers'] = keyword.answer_set.all()
         return context
 
     def get(self, request, *args, **kwargs):
+        # Anonymous visitors (mostly crawlers) get the rendered page from the cache; signed in users and requests with
+        # pending messages always render, since their page differs.
+        cacheable = not request.user.is_authenticated and not get_messages(request)
+        if cacheable:
+            page = get_keyword_page(kwargs['pk'])
+            if page:
+                return keyword_page_response(request, page)
+
         self.object = self.get_object()
 
         if self.request.path != self.object.get_absolute_url():
             return redirect(self.object, permanent=True)
 
-        return super().get(self, request, args, kwargs)
+        response = super().get(self, request, args, kwargs)
+        if cacheable:
+            response.render()
+            page = store_keyword_page(self.object.id, self.object.get_absolute_url(), response.content)
+            return keyword_page_response(request, page)
+        return response
+
+def keyword_page_response(request, page):
+    if request.path != page['path']:
+        return redirect(page['path'], permanent=True)
+    response = HttpResponse(page['content'])
+    response.headers['ETag'] = page['etag']
+    response.headers['Last-Modified'] = http_date(page['last_modified'])
+    # Public, so a CDN can serve the page too; Vary keeps signed in users' pages out of shared caches
+    patch_cache_control(response, public=True, max_age=settings.KEYWORD_PAGE_MAX_AGE)
+    patch_vary_headers(response, ['Cookie'])
+    return get_conditional_response(request, etag=page['etag'], last_modified=int(page['last_modified']), response=response)
 
 def keyword_answer(request, ai_model_id, keyword_id):
     keyword = get_object_or_404(Keyword, id = keyword_id)
@@ -180,7 +188,7 @@ def keyword_gap(request, brand1_id=None, brand2_id=None):
         context['brand1'] = brand1 
         context['brand2'] = brand2
         search_query = SearchQuery(f"{brand1.brand} OR {brand2.brand}", search_type="websearch")
-        context['keyword_list'] = Keyword.objects.annotate(rank=SearchRank(F("search_vector"), search_query)).annotate(traffic=(Max('keywordposition__search_volume'))).filter(search_vector=search_query).exclude(ai_answer__isnull=True).order_by("-traffic")[:100]
+        context['keyword_list'] = Keyword.objects.annotate(rank=SearchRank(F("search_vector"), search_query)).annotate(traffic=(Max('positionsnapshot__search_volume'))).filter(search_vector=search_query).exclude(ai_answer__isnull=True).order_by("-traffic")[:100]
     return render(request, 'ranker/keyword_gap.html', context)
 
 
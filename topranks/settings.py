@@ -198,6 +198,17 @@ DATABASES = {
 }
 CONN_MAX_AGE = 60 #seconds to keep database connection alive
 
+# Rendered responses (sitemaps, keyword pages) are cached in their own Redis database, apart from the Celery broker (db 0),
+# result backend (db 1) and application state (db 2), so clearing the cache never touches queues or counters.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f"redis://{os.getenv('REDIS_HOST', 'localhost')}:6379/3",
+        'OPTIONS': {'password': os.getenv("REDIS_PASS")},
+        'KEY_PREFIX': 'topranks',
+    }
+}
+
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.sqlite3',
@@ -328,6 +339,60 @@ CELERY_RESULT_CACHE_MAX = 50000
 CELERY_RESULT_EXPIRES = 7200 #2 hours
 CELERY_WORKER_MAX_TASKS_PER_CHILD = 200
 
+# OpenAI dispatcher settings
+# Keywords are sent to the API in batches, each batch handled by one task that keeps many requests in flight with asyncio.
+OPENAI_DISPATCH_BATCH_SIZE  = int(os.environ.get("OPENAI_DISPATCH_BATCH_SIZE", 1000))
+OPENAI_DISPATCH_CONCURRENCY = int(os.environ.get("OPENAI_DISPATCH_CONCURRENCY", 200))
+# Claimed keywords are leased to the batch that will answer them. Running batches renew their leases, and keywords
+# whose lease runs out (lost task, dead worker) are returned to the available pool by ranker.tasks.reap_keyword_leases.
+KEYWORD_LEASE_SECONDS       = int(os.environ.get("KEYWORD_LEASE_SECONDS", 1800))
+# A running keyword file import renews its lease after every chunk. Imports whose lease runs out are marked failed by
+# ranker.tasks.reap_keyword_imports, so the file can be queued again and resume from its checkpoint.
+KEYWORD_IMPORT_LEASE_SECONDS = int(os.environ.get("KEYWORD_IMPORT_LEASE_SECONDS", 900))
+
+# Keyword priority, recomputed by ranker.tasks.score_keywords. Refills answer the highest priority keywords first.
+# priority = 1000 * ln(1 + search volume) * (1 + BRAND_WEIGHT * ln(1 + brands)) + AGE_POINTS * min(age in days, AGE_DAYS) / AGE_DAYS
+# The age term is added, so keywords without search volume still rise; at AGE_DAYS it matches a volume of about 150.
+KEYWORD_PRIORITY_BRAND_WEIGHT   = 0.5
+KEYWORD_PRIORITY_AGE_POINTS     = 5000
+KEYWORD_PRIORITY_AGE_DAYS       = 90
+
+# Account-wide OpenAI limits, enforced across every worker by the Redis token bucket in ranker/ratelimit.py
+OPENAI_REQUESTS_PER_MINUTE  = int(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 3500))
+OPENAI_TOKENS_PER_MINUTE    = int(os.environ.get("OPENAI_TOKENS_PER_MINUTE", 90000))
+OPENAI_RATE_LIMIT_BURST_SECONDS = 10 # Bucket capacity, in seconds worth of the per-minute limits
+OPENAI_EXPECTED_COMPLETION_TOKENS = 700 # Reserved per request until the API reports actual usage
+
+# Adaptive (AIMD) limit on OpenAI requests in flight across all workers, see ranker/concurrency.py
+OPENAI_CONCURRENCY_INITIAL  = 50
+OPENAI_CONCURRENCY_MIN      = 5
+OPENAI_CONCURRENCY_MAX      = int(os.environ.get("OPENAI_CONCURRENCY_MAX", 500))
+OPENAI_CONCURRENCY_INCREASE_STEP    = 5     # Added to the limit after a healthy interval
+OPENAI_CONCURRENCY_DECREASE_FACTOR  = 0.7   # Multiplied into the limit after a congested interval
+OPENAI_CONCURRENCY_MAX_ERROR_RATE   = 0.02  # Share of throttled or timed out requests that counts as congested
+OPENAI_CONCURRENCY_TARGET_P95       = 45    # Seconds
+OPENAI_CONCURRENCY_ADJUST_SECONDS   = 10
+OPENAI_CONCURRENCY_WINDOW           = 1000  # Most recent samples considered at each adjustment
+OPENAI_CONCURRENCY_MIN_SAMPLES      = 20
+OPENAI_CONCURRENCY_SLOT_TIMEOUT     = 600   # Seconds before a slot held by a dead worker is reclaimed
+OPENAI_CONCURRENCY_POLL_SECONDS     = 0.5
+
+# Completion cache in front of the OpenAI API, see ranker/cache.py
+OPENAI_CACHE_TTL_DAYS       = int(os.environ.get("OPENAI_CACHE_TTL_DAYS", 30))
+OPENAI_CACHE_MAX_ENTRIES    = int(os.environ.get("OPENAI_CACHE_MAX_ENTRIES", 500000))
+
+# Rendered keyword pages for anonymous visitors, see ranker/pagecache.py. Bump the version whenever the keyword page
+# layout changes, so pages rendered with the old templates are never served again.
+KEYWORD_PAGE_CACHE_VERSION  = int(os.environ.get("KEYWORD_PAGE_CACHE_VERSION", 1))
+KEYWORD_PAGE_CACHE_SECONDS  = 60 * 60 * 24 * 7
+KEYWORD_PAGE_MAX_AGE        = 60 * 60 # Cache-Control max-age sent to browsers and the CDN
+
+# Related keyword links on keyword pages, computed by ranker.tasks.refresh_related_keywords: the best matches of each
+# follow up query, up to a limit per keyword, recomputed after an answer and then every REFRESH_DAYS.
+RELATED_KEYWORDS_PER_QUERY      = 3
+RELATED_KEYWORDS_LIMIT          = 12
+RELATED_KEYWORDS_REFRESH_DAYS   = 30
+
 #THESE USE EST NOT UTC!!! See CELERY_TIME_ZONE above.
 # 0 is Sunday, 6 is Saturday
 CELERY_BEAT_SCHEDULE = {
@@ -339,6 +404,43 @@ CELERY_BEAT_SCHEDULE = {
         "task": "ranker.tasks.build_sitemaps",
         "schedule": crontab(minute=8,hour=1, day_of_week=6), #Should build at 5:08am UTC or 1:08am EST, on Saturday
     },
+    "refresh_related_keywords": {
+        "task": "ranker.tasks.refresh_related_keywords",
+        "schedule": crontab(minute="*/5"),
+    },
+    "refresh_sitemaps": {
+        "task": "ranker.tasks.refresh_sitemaps",
+        "schedule": crontab(minute="*/30"),
+    },
+    "reap_keyword_leases": {
+        "task": "ranker.tasks.reap_keyword_leases",
+        "schedule": 60.0, #Seconds
+    },
+    "reap_keyword_imports": {
+        "task": "ranker.tasks.reap_keyword_imports",
+        "schedule": crontab(minute="*/5"),
+    },
+    "keyword_volumes": {
+        "task": "ranker.tasks.keyword_volumes",
+        "schedule": crontab(minute="*/10"),
+        "kwargs": {"incremental": True},
+    },
+    "keyword_volumes_full": {
+        "task": "ranker.tasks.keyword_volumes",
+        "schedule": crontab(minute=45, hour=3), #Catches what the incremental runs miss, see keyword_volumes
+    },
+    "score_keywords": {
+        "task": "ranker.tasks.score_keywords",
+        "schedule": crontab(minute=15),
+    },
+    "compact_statistics": {
+        "task": "ranker.tasks.compact_statistics",
+        "schedule": 60.0, #Seconds
+    },
+    "prune_completion_cache": {
+        "task": "ranker.tasks.prune_completion_cache",
+        "schedule": crontab(minute=30, hour=3),
+    },
     "index_brands": {
         "task": "ranker.tasks.index_brands",
         "schedule": crontab(minute="*/5"),